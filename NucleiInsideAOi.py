@@ -8,17 +8,22 @@
 from ij import IJ, WindowManager, ImagePlus
 from ij.io import DirectoryChooser, FileSaver
 from ij.plugin.frame import RoiManager
-from ij.gui import Overlay, PolygonRoi, Roi
-from ij.measure import ResultsTable, Measurements
-from ij.plugin.filter import ParticleAnalyzer
-from ij.process import ImageStatistics as IS, ImageConverter, ByteProcessor
+from ij.gui import Overlay, PolygonRoi, Roi, Wand
+from ij.process import ImageStatistics as IS, ImageConverter, ByteProcessor, ImageProcessor
 from ij.plugin import RGBStackMerge
 from java.io import File, FileWriter, BufferedWriter, PrintWriter
-from java.lang import Double
+from java.lang import Double, StringBuilder
 from java.awt import Color
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
-import time, re, jarray
+from loci.formats import ImageReader
+from loci.common import NIOFileHandle
+from java.lang import Runtime
+from java.util.concurrent import ThreadPoolExecutor, ArrayBlockingQueue, TimeUnit
+import re, math, jarray
+
+# Small NIO buffers make Bio-Formats initialization noticeably faster than the 1 MB default
+NIOFileHandle.setDefaultBufferSize(16384)
 
 # -------- Settings --------
 SPLIT_BY    = IJ.getString("Split inside script? (none/series/time/z)", "none").lower().strip()
@@ -52,10 +57,12 @@ AOI_ROI_MIN_FRAC     = AOI_ROI_MIN_FRAC_PCT / 100.0
 SAT_DAPI_PCT = float(IJ.getNumber("DAPI overlay saturation (%)", 1.0))
 ENHANCE      = IJ.getString("Enhance contrast before saving? (yes/no)","no").lower().strip() in ("yes","y","ja","j","true","1")
 STROKE_W     = int(IJ.getNumber("Overlay stroke width (px)", 2))
+NUC_COLOR    = Color(0,255,0)  # nucleus outlines
 SHOW_ONLY_IN_AOI = True
 
 # -------- Helpers --------
-def safe_name(s): return re.sub(r'[\\/:*?"<>|]+', '_', s)[:180]
+_SAFE_RE = re.compile(r'[\\/:*?"<>|]+')
+def safe_name(s): return _SAFE_RE.sub('_', s)[:180]
 
 def list_open_images():
     imgs=[]
@@ -64,15 +71,21 @@ def list_open_images():
         if im: imgs.append(im)
     return imgs
 
+# Series windows as (image, lowercased title) pairs so the channel picks don't re-query titles
 def list_series_images(series):
     key=(series or "").lower()
-    return [im for im in list_open_images() if key in ((im.getTitle() or "").lower())]
+    titled=[(im, (im.getTitle() or "").lower()) for im in list_open_images()]
+    return [(im, t) for im, t in titled if key in t]
+
+def pick_by_title(patterns, titled):
+    for im, t in titled:
+        if any(p in t for p in patterns): return im
+    return None
 
-def pick_dapi_image(patterns, candidates):
-    for im in candidates:
-        if any(p in (im.getTitle() or "").lower() for p in patterns):
-            return im
-    return candidates[0] if candidates else None
+def pick_dapi_image(patterns, titled):
+    im=pick_by_title(patterns, titled)
+    if im is None and titled: im=titled[0][0]
+    return im
 
 def ensure_gray8(imp):
     try:
@@ -93,63 +106,86 @@ def apply_blue_rgb(imp):
         IJ.run(imp, "RGB Color", "")
     except: pass
 
-def export_csv(path, row, header):
+# Open a CSV for appending (64 KB buffer); header is written only when the file is new
+def open_csv(path, header):
     f=File(path); first=not f.exists()
-    pw=PrintWriter(BufferedWriter(FileWriter(f,True)))
-    try:
-        if first: pw.println(header)
-        pw.println(row)
+    pw=PrintWriter(BufferedWriter(FileWriter(f,True), 65536))
+    if first: pw.println(header)
+    return pw
+
+def export_csv(path, row, header):
+    pw=open_csv(path, header)
+    try: pw.println(row)
     finally: pw.close()
 
-def roi_pixel_iter(ip, roi):
-    if ip is None or roi is None: return
-    b=roi.getBounds(); rmask=roi.getMask()
-    W,H=ip.getWidth(), ip.getHeight()
-    for yy in range(b.height):
-        gy=b.y+yy
-        if gy<0 or gy>=H: continue
-        for xx in range(b.width):
-            gx=b.x+xx
-            if gx<0 or gx>=W: continue
-            if rmask is not None and rmask.get(xx,yy)==0: continue
-            yield gx,gy
-
-def roi_area_pixels(ip, roi):
-    c=0
-    for _ in roi_pixel_iter(ip, roi): c+=1
-    return c
-
-def roi_mean(ip, roi):
-    s=0; n=0
-    for gx,gy in roi_pixel_iter(ip, roi):
-        s+=ip.get(gx,gy); n+=1
-    return (float(s)/n) if n>0 else 0.0
+# Set an ROI on a processor, reusing pre-fetched bounds/mask when the ROI lies fully inside the image
+def set_roi(ip, roi, b=None, mask=None):
+    if b is not None and b.x>=0 and b.y>=0 and b.x+b.width<=ip.getWidth() and b.y+b.height<=ip.getHeight():
+        ip.setRoi(b); ip.setMask(mask)
+    else:
+        ip.setRoi(roi)
+
+# Area (px) and mean of an ROI via ImageJ's native statistics instead of a per-pixel Jython loop
+def roi_stats(ip, roi, b=None, mask=None):
+    set_roi(ip, roi, b, mask)
+    try: return IS.getStatistics(ip, IS.MEAN | IS.AREA | IS.STD_DEV, None)
+    finally: ip.resetRoi()
+
+# Fraction of ROI pixels that are non-zero in a binary ByteProcessor mask (native ROI-masked histogram)
+def mask_overlap_frac(mask_ip, roi, b=None, mask=None):
+    set_roi(mask_ip, roi, b, mask)
+    try: hist=mask_ip.getHistogram()
+    finally: mask_ip.resetRoi()
+    allpix=sum(hist)
+    return (float(allpix-hist[0])/float(allpix)) if allpix>0 else 0.0
+
+# Foreground fraction of the whole mask; 0 or 1 means every ROI gets the same AOI answer
+def mask_fill(mask_ip):
+    hist=mask_ip.getHistogram(); allpix=sum(hist)
+    return (float(allpix-hist[0])/float(allpix)) if allpix>0 else 0.0
 
 def close_if_open(imp):
     try:
         if imp is not None: imp.changes=False; imp.close()
     except: pass
 
-# Compute circularity reliably using ParticleAnalyzer on a binary mask of the ROI
-def circ_from_roi(roi):
+# PNG encoding runs on one background thread so it overlaps the next series' StarDist run;
+# the image must not be touched by the caller afterwards (the task closes it). The queue holds at most
+# 8 images; when it is full the caller saves inline instead of piling overlays up in memory
+SAVE_POOL = ThreadPoolExecutor(1, 1, 0, TimeUnit.SECONDS, ArrayBlockingQueue(8), ThreadPoolExecutor.CallerRunsPolicy())
+def save_png_async(imp, path):
+    def task():
+        try: FileSaver(imp).saveAsPng(path)
+        except Exception as e: IJ.log("PNG save failed %s: %s" % (path, str(e)))
+        finally: close_if_open(imp)
+    SAVE_POOL.execute(task)
+
+# Circularity 4*pi*area/perimeter^2 (as reported by ParticleAnalyzer, capped at 1): the perimeter is
+# taken from the traced pixel outline of the ROI mask, like ParticleAnalyzer, not from the smooth polygon
+def traced_perimeter(roi):
+    mask=roi.getMask()
+    if mask is None:
+        b=roi.getBounds(); return 2.0*(b.width+b.height)
+    pix=mask.getPixels(); w=mask.getWidth()
+    start=next((i for i in xrange(len(pix)) if pix[i]!=0), -1)
+    if start<0: return 0.0
+    wand=Wand(mask); wand.autoOutline(start % w, start // w, 255.0, 255.0, Wand.LEGACY_MODE)
+    return PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI).getLength()
+
+def circ_from_roi(roi, area=None):
     try:
-        mask = roi.getMask()
-        if mask is None:
-            return Double.NaN
-        imp_mask = ImagePlus("roiMask", mask)
-        IJ.setThreshold(imp_mask, 1, Double.POSITIVE_INFINITY)
-        rtloc = ResultsTable()
-        pa = ParticleAnalyzer(ParticleAnalyzer.SHOW_NONE,
-                              Measurements.CIRCULARITY,
-                              rtloc, 0, Double.POSITIVE_INFINITY)
-        pa.setHideOutputImage(True)
-        pa.analyze(imp_mask)
-        if rtloc.getCounter() > 0:
-            return rtloc.getValue("Circ.", 0)
-    except:
-        pass
+        if area is None: area = roi.getStatistics().pixelCount
+        per = traced_perimeter(roi)
+        if per > 0 and area > 0:
+            return min(1.0, 4.0*math.pi*float(area)/(per*per))
+    except: pass
     return Double.NaN
 
+# Bilinear, averaging resize into a new ImagePlus ("Scale... create" without the dialog/window round-trip)
+def resized_copy(imp, new_w, new_h, title):
+    ip=imp.getProcessor(); ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+    return ImagePlus(title, ip.resize(new_w, new_h, True))
+
 # Rescale ROI coordinates from the downscaled working image back to original image size
 def rescale_roi_to_original(roi, sx, sy):
     fp = roi.getFloatPolygon()
@@ -165,49 +201,65 @@ def rescale_roi_to_original(roi, sx, sy):
     except: pass
     return nr
 
+# One ImageReader for the whole run: building its per-format readers costs more than the lookup
+_series_reader=ImageReader()
+def count_series(path):
+    try:
+        _series_reader.setId(path); return _series_reader.getSeriesCount()
+    finally: _series_reader.close(True)
+
+# Optionally restrict processing to the first or second half of the series
+def select_series(total):
+    if SPLIT_BY == "series" and total > 1:
+        cut=total//2
+        return range(0, cut) if SPLIT_WHICH=="first" else range(cut, total)
+    return range(total)
+
+# Virtual stacks only pay off when only part of a stack is used (time/z split) or the file may not
+# fit in RAM; otherwise Split Channels and the duplicates would re-read every plane from disk
+def use_virtual(f):
+    if SPLIT_BY in ("time","z"): return True
+    return f.length() > Runtime.getRuntime().maxMemory()//4
+
 # -------- Process a single image series --------
 def process_series(imp, series, folder):
     if imp is None:
         IJ.log("Skip %s (imp=None)" % series); return
 
-    imp.setTitle(series); imp.show(); time.sleep(0.2)
+    # show(), Split Channels and the StarDist command all return once their windows exist: no sleeps needed
+    imp.setTitle(series); imp.show()
     try: IJ.run(imp, "Split Channels", "")
     except: pass
-    time.sleep(0.2)
 
-    series_wins=list_series_images(series)
+    titled=list_series_images(series)
+    series_wins=[w for w, _ in titled]
     if not series_wins:
         IJ.log("No channels opened for %s" % series); close_if_open(imp); return
 
-    dapi=pick_dapi_image(CHANNEL_PATTERNS, series_wins)
+    dapi=pick_dapi_image(CHANNEL_PATTERNS, titled)
     if dapi is None:
         IJ.log("No DAPI in %s" % series)
         for w in series_wins: close_if_open(w); close_if_open(imp); return
 
     # Find the AOI channel window if AOI identifiers were configured
-    aoi=None
-    if AOI_KEYS:
-        for win in series_wins:
-            if any(k in (win.getTitle() or "").lower() for k in AOI_KEYS):
-                aoi=win; break
+    aoi=pick_by_title(AOI_KEYS, titled) if AOI_KEYS else None
 
     dapi_disp=dapi.duplicate(); ensure_gray8(dapi_disp); dapi_disp.setTitle(series+"_DAPI_GRAY"); dapi_disp.show()
 
     # --- Run StarDist and collect detected nuclei into the ROI Manager ---
     orig_w, orig_h = dapi.getWidth(), dapi.getHeight()
-    work = dapi.duplicate(); work.setTitle(series + "_work"); work.show()
     rm = RoiManager.getInstance() or RoiManager(); rm.reset()
 
     work_w, work_h = orig_w, orig_h
     if abs(SCALE_FACTOR-1.0)>1e-6:
         new_w=max(1, int(round(orig_w*SCALE_FACTOR)))
         new_h=max(1, int(round(orig_h*SCALE_FACTOR)))
-        IJ.run(work, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" %
-               (SCALE_FACTOR, SCALE_FACTOR, new_w, new_h))
-        scaled=WindowManager.getCurrentImage()
-        if scaled is not None:
-            close_if_open(work); work=scaled
+        work = resized_copy(dapi, new_w, new_h, series + "_work")
         work_w, work_h = work.getWidth(), work.getHeight()
+    else:
+        # StarDist only reads its input, so the DAPI channel window is used as-is, under its own title
+        work = dapi
+    work.show()
 
     cmd=("command=[de.csbdresden.stardist.StarDist2D],"
          "args=['input':'%s','modelChoice':'%s','normalizeInput':'true',"
@@ -215,14 +267,14 @@ def process_series(imp, series, folder):
          "'outputType':'ROI Manager','nTiles':'%s','excludeBoundary':'2','verbose':'false',"
          "'showCsbdeepProgress':'false','showProbAndDist':'false'],process=[false]" %
          (work.getTitle(), model, prob, nms, tiles_str))
-    IJ.run("Command From Macro", cmd); time.sleep(0.4)
+    IJ.run("Command From Macro", cmd)
 
     rm = RoiManager.getInstance() or RoiManager()
     rois_rm = list(rm.getRoisAsArray()) if rm else []
     if not rois_rm:
         IJ.log("No ROIs from StarDist in %s" % series)
         close_if_open(work); close_if_open(dapi_disp)
-        for w in series_wins: close_if_open(w); close_if_open(imp); IJ.run("Collect Garbage",""); return
+        for w in series_wins: close_if_open(w); close_if_open(imp); return
 
     # Rescale StarDist ROIs back to original image dimensions if pre-scaling was applied
     if work_w != orig_w or work_h != orig_h:
@@ -230,13 +282,7 @@ def process_series(imp, series, folder):
         sy = float(orig_h) / float(work_h)
         rois_array = [rescale_roi_to_original(r, sx, sy) for r in rois_rm]
     else:
-        rois_array = rois_rm[:]
-
-    # Reload rescaled ROIs into the ROI Manager for visualization
-    rm.reset()
-    for r in rois_array:
-        try: rm.addRoi(r)
-        except: pass
+        rois_array = rois_rm
 
     # --- Compute DAPI background mean and std using full-image statistics ---
     dapi_ip=dapi.getProcessor()
@@ -246,7 +292,7 @@ def process_series(imp, series, folder):
     bg_mean, bg_sd = float(bgstats.mean), float(bgstats.stdDev)
 
     # --- Generate binary AOI mask after optional background subtraction ---
-    aoi_mask_ip=None; aoi_view=None
+    aoi_mask_ip=None; aoi_view=None; aoi_fill=None; aoi_proc=None
     if aoi is not None:
         aoi_proc=aoi.duplicate(); aoi_proc.setTitle(series+"__AOIproc"); aoi_proc.show(); ensure_gray8(aoi_proc)
         if APPLY_BG_AOI:
@@ -257,36 +303,43 @@ def process_series(imp, series, folder):
         IJ.setThreshold(aoi_proc, AOI_THR, Double.POSITIVE_INFINITY)
         IJ.run(aoi_proc, "Convert to Mask", "black")
         aoi_mask_ip = aoi_proc.getProcessor()
+        aoi_fill = mask_fill(aoi_mask_ip)
 
     # --- Apply size, intensity, and AOI overlap filters; collect per-ROI measurements ---
-    kept=[]  # (roi, area_px, in_aoi, circ)
+    # Single lower bound for the mean; checks run cheapest first and bail out early
+    min_mean=max(MIN_MEAN_INTENSITY if MIN_MEAN_INTENSITY>0 else -Double.MAX_VALUE,
+                 (bg_mean + SIGMA_ABOVE_BG*bg_sd) if SIGMA_ABOVE_BG>0 else -Double.MAX_VALUE)
+    # Kept ROIs as parallel columns (one list per field) rather than a list of tuples
+    kept_rois=[]; kept_area=[]; kept_in=[]; kept_circ=[]
     for roi in rois_array:
-        area_px=roi_area_pixels(dapi_ip, roi)
+        b=roi.getBounds()
+        if b.width*b.height<size_min: continue  # bounding box can't hold enough pixels
+        rmask=roi.getMask()
+        st=roi_stats(dapi_ip, roi, b, rmask)
+        area_px=int(st.pixelCount)
         if area_px<size_min or area_px>size_max: continue
-        mval=roi_mean(dapi_ip, roi)
-        if (MIN_MEAN_INTENSITY>0 and mval<MIN_MEAN_INTENSITY): continue
-        if (SIGMA_ABOVE_BG>0 and mval<bg_mean + SIGMA_ABOVE_BG*bg_sd): continue
+        mval=float(st.mean) if area_px>0 else 0.0
+        if mval<min_mean: continue
 
         in_aoi=False
-        if aoi_mask_ip is not None:
-            inside=allpix=0
-            for gx,gy in roi_pixel_iter(aoi_mask_ip, roi):
-                allpix+=1
-                if aoi_mask_ip.get(gx,gy)>0: inside+=1
-            in_aoi=(allpix>0 and float(inside)/float(allpix) >= AOI_ROI_MIN_FRAC)
+        if aoi_fill in (0.0, 1.0):
+            in_aoi=(aoi_fill >= AOI_ROI_MIN_FRAC)
+        elif aoi_mask_ip is not None:
+            in_aoi=(mask_overlap_frac(aoi_mask_ip, roi, b, rmask) >= AOI_ROI_MIN_FRAC)
 
-        circ = circ_from_roi(roi)
-        kept.append((roi, area_px, in_aoi, circ))
+        kept_rois.append(roi); kept_area.append(area_px); kept_in.append(in_aoi)
+        kept_circ.append(circ_from_roi(roi, area_px))
 
+    # Load the manager once with the final ROI set (every addRoi fires a list/repaint update)
     rm.reset()
-    for r,_,_,_ in kept:
+    for r in kept_rois:
         try: rm.addRoi(r)
         except: pass
 
-    if not kept:
+    if not kept_rois:
         IJ.log("No nuclei after filtering in %s" % series)
         close_if_open(work); close_if_open(dapi_disp)
-        for w in series_wins: close_if_open(w); close_if_open(imp); IJ.run("Collect Garbage",""); return
+        for w in series_wins: close_if_open(w); close_if_open(imp); return
 
     # --- CSVs ---
     out_dir = File(folder + File.separator + "Nuclei_Only_Overlays")
@@ -295,16 +348,12 @@ def process_series(imp, series, folder):
     PERROI_HDR = "Image;Series;ROI_Index;Area_px;Circ;In_AOI"
     SUM_HDR    = "Image;Series;N_ROIs;N_In_AOI;Mean_Area_px;Mean_Circ;Mean_Circ_In_AOI"
 
-    n_all=len(kept)
-    n_in = sum(1 for k in kept if k[2])
-    mean_area = (sum(k[1] for k in kept)/float(n_all)) if n_all>0 else 0.0
+    n_all=len(kept_rois)
+    n_in = sum(kept_in)
+    mean_area = (sum(kept_area)/float(n_all)) if n_all>0 else 0.0
 
-    circ_vals = []; circ_vals_in = []
-    for k in kept:
-        c = k[3]
-        if not Double.isNaN(c):
-            circ_vals.append(c)
-            if k[2]: circ_vals_in.append(c)
+    circ_vals    = [c for c in kept_circ if not Double.isNaN(c)]
+    circ_vals_in = [c for c, ina in zip(kept_circ, kept_in) if ina and not Double.isNaN(c)]
 
     mean_circ    = (sum(circ_vals)    / float(len(circ_vals)))    if circ_vals    else 0.0
     mean_circ_in = (sum(circ_vals_in) / float(len(circ_vals_in))) if circ_vals_in else 0.0
@@ -313,17 +362,27 @@ def process_series(imp, series, folder):
         image_name, series, n_all, n_in, mean_area, mean_circ, mean_circ_in
     ), SUM_HDR)
 
-    for ridx,k in enumerate(kept,1):
-        roi, area, ina, circ = k[0], k[1], k[2], k[3]
-        circ_str = ("%.6f" % circ) if not Double.isNaN(circ) else ""
-        export_csv(csv_perroi, "%s;%s;%d;%d;%s;%s" % (
-            image_name, series, ridx, area, circ_str, ("TRUE" if ina else "FALSE")
-        ), PERROI_HDR)
+    # Per-ROI rows go through one writer per series instead of reopening the file per row
+    # Rows share one StringBuilder: the "image;series;" prefix is built once and kept via setLength
+    pw_perroi = open_csv(csv_perroi, PERROI_HDR)
+    try:
+        sb=StringBuilder(128); sb.append(image_name).append(";").append(series).append(";")
+        plen=sb.length()
+        for ridx in range(n_all):
+            circ=kept_circ[ridx]
+            sb.setLength(plen)
+            sb.append(ridx+1).append(";").append(kept_area[ridx]).append(";")
+            if not Double.isNaN(circ): sb.append("%.6f" % circ)
+            sb.append(";").append("TRUE" if kept_in[ridx] else "FALSE")
+            pw_perroi.println(sb.toString())
+    finally: pw_perroi.close()
 
     # --- Build RGB composite: AOI in red, DAPI in blue, nucleus outlines drawn on top ---
+    # dapi_disp is already 8-bit; enhance it once and share its pixels with both renders
     W, H = dapi_disp.getWidth(), dapi_disp.getHeight()
-    dapi_gray = dapi_disp.duplicate(); ensure_gray8(dapi_gray)
-    if ENHANCE: IJ.run(dapi_gray, "Enhance Contrast", "saturated=%.3f" % SAT_DAPI_PCT)
+    if ENHANCE: IJ.run(dapi_disp, "Enhance Contrast", "saturated=%.3f" % SAT_DAPI_PCT)
+    disp_ip = dapi_disp.getProcessor()
+    dapi_gray = ImagePlus(series + "_DAPI_B", disp_ip.duplicate())
 
     if aoi_view is not None:
         aoi_gray = aoi_view.duplicate(); ensure_gray8(aoi_gray)
@@ -334,41 +393,37 @@ def process_series(imp, series, folder):
     combo = RGBStackMerge.mergeChannels([aoi_gray, blankG, dapi_gray], False)  # [R,G,B]
     combo.setTitle(series + "__COMBO_AOIred_DAPIblue_NUC")
 
+    # Styled outline clones are made once and shared by both overlays
+    disp_rois = []
+    for roi, ina in zip(kept_rois, kept_in):
+        if SHOW_ONLY_IN_AOI and not ina: disp_rois.append(None); continue
+        r = roi.clone(); r.setStrokeWidth(STROKE_W); r.setStrokeColor(NUC_COLOR)
+        disp_rois.append(r)
+
     ov = Overlay()
-    for k in kept:
-        roi, ina = k[0], k[2]
-        if SHOW_ONLY_IN_AOI and not ina: continue
-        r = roi.clone(); r.setStrokeWidth(STROKE_W); r.setStrokeColor(Color(0,255,0))
-        ov.add(r)
+    for r in disp_rois:
+        if r is not None: ov.add(r)
     combo.setOverlay(ov)
 
-    FileSaver(combo).saveAsPng(out_dir.getAbsolutePath() + File.separator +
-                               safe_name("%s__COMBO_AOIred_DAPIblue_NUC.png" % series))
+    save_png_async(combo, out_dir.getAbsolutePath() + File.separator +
+                   safe_name("%s__COMBO_AOIred_DAPIblue_NUC.png" % series))
 
     # --- DAPI-only overlay showing only nuclei that overlap the AOI ---
     ov_in = Overlay()
-    for k in kept:
-        if not k[2]: continue
-        r = k[0].clone(); r.setStrokeWidth(STROKE_W); r.setStrokeColor(Color(0,255,0))
-        ov_in.add(r)
-    dapi_only = dapi_disp.duplicate(); ensure_gray8(dapi_only)
-    if ENHANCE: IJ.run(dapi_only, "Enhance Contrast", "saturated=%.3f" % SAT_DAPI_PCT)
+    for r, ina in zip(disp_rois, kept_in):
+        if ina: ov_in.add(r)
+    dapi_only = ImagePlus(series + "_DAPIonly", disp_ip.duplicate())
     apply_blue_rgb(dapi_only)
     dapi_only.setOverlay(ov_in)
-    FileSaver(dapi_only).saveAsPng(out_dir.getAbsolutePath() + File.separator +
-                                   safe_name("%s__DAPIonly_NUCinAOI.png" % series))
+    save_png_async(dapi_only, out_dir.getAbsolutePath() + File.separator +
+                   safe_name("%s__DAPIonly_NUCinAOI.png" % series))
 
-    # Close temporary images and free memory
-    for imx in (dapi_only, combo, dapi_gray, aoi_gray, blankG):
+    # Close temporary images and free memory (combo/dapi_only are closed by the save task)
+    for imx in (dapi_gray, aoi_gray, blankG, aoi_proc):
         close_if_open(imx)
-    try:
-        for imx in list_open_images():
-            if imx and ("__AOIproc" in (imx.getTitle() or "")): close_if_open(imx)
-    except: pass
     close_if_open(work); close_if_open(dapi_disp)
     for w in series_wins: close_if_open(w)
     close_if_open(imp)
-    IJ.run("Collect Garbage","")
 
 # -------- Main process: iterate over all input files --------
 folder = DirectoryChooser("Select folder with images").getDirectory()
@@ -383,47 +438,56 @@ files = sorted([f for f in JFile(folder).listFiles()
                if f.isFile() and f.getName().lower().endswith((".tif",".tiff",".png",".jpg",".jpeg",".lif",".nd2"))],
                key=lambda f: f.getName().lower())
 
-for f in files:
-    image_name = f.getName()
-    try:
-        opts = ImporterOptions()
-        opts.setId(f.getAbsolutePath())
-        opts.setOpenAllSeries(True)
-        opts.setVirtual(True)
-        imps = BF.openImagePlus(opts)
-    except:
-        IJ.log("Open failed: %s" % image_name); continue
-    if not imps:
-        IJ.log("No series: %s" % image_name); continue
-
-    # Optionally restrict processing to the first or second half of series, time, or z frames
-    if SPLIT_BY == "series" and len(imps) > 1:
-        total=len(imps); cut=total//2
-        sel = range(0, cut) if SPLIT_WHICH=="first" else range(cut, total)
-    else:
-        sel = range(len(imps))
-
-    for sidx in sel:
-        if sidx<0 or sidx>=len(imps):
-            IJ.log("Index %d out of range for %s (len=%d)" % (sidx, image_name, len(imps)))
-            continue
-        imp = imps[sidx]
-        series = "%s_Series%d" % (image_name, sidx+1) if len(imps)>1 else image_name
-
-        if SPLIT_BY in ("time","z"):
-            nT=max(1, imp.getNFrames()); nZ=max(1, imp.getNSlices())
-            if SPLIT_BY=="time" and nT>1:
-                half=nT//2; rng=("1-%d" % half) if SPLIT_WHICH=="first" else ("%d-%d" % (half+1, nT))
-                ch=imp.getNChannels(); zall=imp.getNSlices()
-                IJ.run(imp, "Duplicate...", "title=%s__part duplicate channels=1-%d slices=1-%d frames=%s" % (series, ch, zall, rng))
-                part=WindowManager.getCurrentImage(); process_series(part, series+"__T_"+SPLIT_WHICH, folder); continue
-            elif SPLIT_BY=="z" and nZ>1:
-                half=nZ//2; rng=("1-%d" % half) if SPLIT_WHICH=="first" else ("%d-%d" % (half+1, nZ))
-                ch=imp.getNChannels(); tall=imp.getNFrames()
-                IJ.run(imp, "Duplicate...", "title=%s__part duplicate channels=1-%d slices=%s frames=1-%d" % (series, ch, rng, tall))
-                part=WindowManager.getCurrentImage(); process_series(part, series+"__Z_"+SPLIT_WHICH, folder); continue
-
-        process_series(imp, series, folder)
+try:
+    for f in files:
+        image_name = f.getName()
+        try:
+            opts = ImporterOptions()
+            opts.setId(f.getAbsolutePath())
+            if SPLIT_BY == "series":
+                # Switch on only the selected half instead of opening every series
+                n_series = count_series(f.getAbsolutePath())
+                sel = select_series(n_series)
+                opts.clearSeries()
+                for sidx in sel: opts.setSeriesOn(sidx, True)
+            else:
+                opts.setOpenAllSeries(True)
+            opts.setVirtual(use_virtual(f))
+            imps = BF.openImagePlus(opts)
+        except:
+            IJ.log("Open failed: %s" % image_name); continue
+        if not imps:
+            IJ.log("No series: %s" % image_name); continue
+        if SPLIT_BY != "series":
+            n_series = len(imps); sel = range(n_series)
+
+        for k, sidx in enumerate(sel):
+            if k>=len(imps):
+                IJ.log("Index %d out of range for %s (len=%d)" % (sidx, image_name, len(imps)))
+                continue
+            imp = imps[k]
+            series = "%s_Series%d" % (image_name, sidx+1) if n_series>1 else image_name
+
+            if SPLIT_BY in ("time","z"):
+                nT=max(1, imp.getNFrames()); nZ=max(1, imp.getNSlices())
+                if SPLIT_BY=="time" and nT>1:
+                    half=nT//2; rng=("1-%d" % half) if SPLIT_WHICH=="first" else ("%d-%d" % (half+1, nT))
+                    ch=imp.getNChannels(); zall=imp.getNSlices()
+                    IJ.run(imp, "Duplicate...", "title=%s__part duplicate channels=1-%d slices=1-%d frames=%s" % (series, ch, zall, rng))
+                    part=WindowManager.getCurrentImage(); process_series(part, series+"__T_"+SPLIT_WHICH, folder); continue
+                elif SPLIT_BY=="z" and nZ>1:
+                    half=nZ//2; rng=("1-%d" % half) if SPLIT_WHICH=="first" else ("%d-%d" % (half+1, nZ))
+                    ch=imp.getNChannels(); tall=imp.getNFrames()
+                    IJ.run(imp, "Duplicate...", "title=%s__part duplicate channels=1-%d slices=%s frames=1-%d" % (series, ch, rng, tall))
+                    part=WindowManager.getCurrentImage(); process_series(part, series+"__Z_"+SPLIT_WHICH, folder); continue
+
+            process_series(imp, series, folder)
+
+        # One collection per file; closing the series windows already released their pixel arrays
+        IJ.run("Collect Garbage","")
+finally:
+    # Wait for queued overlay PNGs before reporting completion
+    SAVE_POOL.shutdown(); SAVE_POOL.awaitTermination(1, TimeUnit.HOURS)
 
 IJ.log("Done. CSVs:")
 IJ.log(" - " + csv_perroi)
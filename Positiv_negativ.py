@@ -5,17 +5,25 @@
 
 from ij import IJ, WindowManager, ImagePlus
 from ij.io import DirectoryChooser, FileSaver
+from ij.macro import Interpreter
 from ij.plugin.frame import RoiManager
+from ij.plugin import ChannelSplitter
 from ij.gui import Overlay, TextRoi, ShapeRoi, PolygonRoi, Roi
-from ij.measure import ResultsTable, Measurements
+from ij.measure import ResultsTable
 from ij.plugin.filter import ParticleAnalyzer
-from ij.process import ImageStatistics as IS
+from ij.process import ImageStatistics as IS, ImageProcessor, ByteProcessor
 from java.io import File, FileWriter, BufferedWriter, PrintWriter
-from java.lang import Double
-from java.awt import Color
+from java.lang import Double, Float, StringBuilder, System, Runtime
+from java.awt import Color, Rectangle
+from java.awt.geom import GeneralPath
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
-import time, re, jarray
+from loci.common import NIOFileHandle
+from java.util.concurrent import Callable, Executors, ThreadPoolExecutor, ArrayBlockingQueue, TimeUnit
+import re, jarray
+
+# Smaller NIO buffers than the 1 MB Bio-Formats default make each file quicker to initialize
+NIOFileHandle.setDefaultBufferSize(16384)
 
 # ==========================
 #          Settings
@@ -59,12 +67,27 @@ SIGMA_ABOVE_BG     = IJ.getNumber("Min σ above background (0=off)", 1.5)
 MIN_MEAN_INTENSITY = IJ.getNumber("Min mean intensity (0=off; image units)", 0)
 
 POS_PIXELS_FRACTION_PCT = IJ.getNumber("Min. fraction of ROI pixels ≥ marker thr (%)", 5.0)
+NATIVE_CLASSIFY = True  # False = count positive pixels with the Jython array scan (roi_scan) instead
 COLOR_POS = Color(0,255,0)
 COLOR_NEG = Color(255,0,0)
 
 # ==========================
 #      Helper functions
 # ==========================
+def open_series(f):
+    opts = ImporterOptions(); opts.setId(f.getAbsolutePath()); opts.setOpenAllSeries(True); opts.setVirtual(use_virtual(f)); opts.setQuiet(True)
+    return BF.openImagePlus(opts)
+
+# Background read of the next file while the current one is analysed (the images are not shown until used)
+class OpenTask(Callable):
+    def __init__(self, f): self.f = f
+    def call(self): return open_series(self.f)
+
+# Virtual stacks only pay off when the file may not fit in RAM; every plane is split and read here anyway.
+# The budget is half that of the other scripts: with the prefetch, two files can be in memory at once
+def use_virtual(f):
+    return f.length() > Runtime.getRuntime().maxMemory() // 8
+
 def close_stardist_dialogs():
     for w in WindowManager.getNonImageWindows():
         try:
@@ -74,50 +97,116 @@ def close_stardist_dialogs():
             pass
 
 def preprocess_marker(imp):
+    # Without background subtraction the marker channel is only read, so no copy is needed
+    if not APPLY_BG: return imp, imp.getProcessor()
     dup = imp.duplicate(); dup.show()
-    if APPLY_BG:
-        if MEDIAN_RADIUS > 0:
-            IJ.run(dup, "Median...", "radius=%d" % int(MEDIAN_RADIUS))
-        for _ in range(max(1, int(ROLLING_REPEAT))):
-            IJ.run(dup, "Subtract Background...", "rolling=%d" % int(ROLLING_RADIUS))
+    if MEDIAN_RADIUS > 0:
+        IJ.run(dup, "Median...", "radius=%d" % int(MEDIAN_RADIUS))
+    for _ in range(max(1, int(ROLLING_REPEAT))):
+        IJ.run(dup, "Subtract Background...", "rolling=%d" % int(ROLLING_RADIUS))
     return dup, dup.getProcessor()
 
-def roi_pixel_iter(ip, roi):
-    b = roi.getBounds()
-    W = ip.getWidth(); H = ip.getHeight()
-    rmask = roi.getMask()
-    for yy in range(b.height):
-        gy = b.y + yy
-        if gy < 0 or gy >= H: continue
-        for xx in range(b.width):
-            gx = b.x + xx
-            if gx < 0 or gx >= W: continue
-            if rmask is not None and rmask.get(xx, yy) == 0: continue
-            yield gx, gy
-
-def roi_area_pixels(ip, roi):
-    c = 0
-    for _ in roi_pixel_iter(ip, roi): c += 1
-    return c
-
-def roi_mean(ip, roi):
-    s = 0.0; n = 0
-    for gx, gy in roi_pixel_iter(ip, roi):
-        s += ip.get(gx, gy); n += 1
-    return (s / n) if n > 0 else 0.0
-
-def export_counts_row(csv_path, row, header):
-    f = File(csv_path); first = not f.exists()
-    pw = PrintWriter(BufferedWriter(FileWriter(f, True)))
-    try:
-        if first: pw.println(header)
-        pw.println(row)
-    finally:
-        pw.close()
+# Raw pixel array of a processor plus the mask that turns Jython's signed byte/short into unsigned values
+def pixel_array(ip):
+    pix = ip.getPixels()
+    if ip.getBitDepth() == 8:  return pix, 0xff
+    if ip.getBitDepth() == 16: return pix, 0xffff
+    return pix, 0
+
+# One flat pass over the ROI's mask and the image array (bounding box clipped to the image once):
+# returns (pixel count, intensity sum, count of pixels >= thr)
+def roi_scan(pa, W, H, roi, thr=None, b=None, rmask=None):
+    pix, vmask = pa
+    if b is None: b = roi.getBounds(); rmask = roi.getMask()
+    mpx = rmask.getPixels() if rmask is not None else None
+    x0 = max(0, b.x); x1 = min(W, b.x + b.width)
+    y0 = max(0, b.y); y1 = min(H, b.y + b.height)
+    n = 0; s = 0.0; npos = 0
+    for gy in xrange(y0, y1):
+        base = gy * W
+        mbase = (gy - b.y) * b.width - b.x
+        for gx in xrange(x0, x1):
+            if mpx is not None and mpx[mbase + gx] == 0: continue
+            v = pix[base + gx]
+            if vmask: v &= vmask
+            n += 1; s += v
+            if thr is not None and v >= thr: npos += 1
+    return n, s, npos
+
+# Binary mask (255 where pixel >= thr) of a marker, built once per marker by ImageJ
+def threshold_mask(ip, thr):
+    ip.setThreshold(thr, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+    try: return ip.createMask()
+    finally: ip.resetThreshold()
+
+# Set an ROI on a processor, reusing pre-fetched bounds/mask when the ROI lies fully inside the image
+def set_roi(ip, roi, b=None, mask=None):
+    if b is not None and b.x>=0 and b.y>=0 and b.x+b.width<=ip.getWidth() and b.y+b.height<=ip.getHeight():
+        ip.setRoi(b); ip.setMask(mask)
+    else:
+        ip.setRoi(roi)
+
+# Fraction of 255-valued pixels in a whole binary mask (0 or 1 = every ROI gets the same answer)
+def mask_fill(mask_ip):
+    hist = mask_ip.getHistogram(); allpix = sum(hist)
+    return (float(hist[255]) / float(allpix)) if allpix > 0 else 0.0
+
+# Mean/SD of everything outside the ROIs: the ROIs are filled into one 8-bit mask whose inverse is the
+# background mask (no ROIs -> whole image), so there is no ShapeRoi union to build
+def background_stats(ip, rois, cal=None):
+    W, H = ip.getWidth(), ip.getHeight()
+    fg = ByteProcessor(W, H); fg.setValue(255)
+    for r in rois:
+        try: fg.fill(r)
+        except: pass
+    fg.invert()
+    ip.setRoi(Rectangle(0, 0, W, H)); ip.setMask(fg)
+    try: return IS.getStatistics(ip, IS.MEAN | IS.STD_DEV, cal)
+    finally: ip.resetRoi()
+
+def roi_stats(ip, roi, b=None, mask=None):
+    set_roi(ip, roi, b, mask)
+    try: return IS.getStatistics(ip, IS.MEAN | IS.AREA, None)
+    finally: ip.resetRoi()
+
+# PNG encoding runs on one background thread. The overlay is burnt in here (what saveAsPng would do),
+# so the caller can keep changing the source image; a full queue makes the caller save inline.
+SAVE_POOL = ThreadPoolExecutor(1, 1, 0, TimeUnit.SECONDS, ArrayBlockingQueue(8), ThreadPoolExecutor.CallerRunsPolicy())
+def save_png_async(imp, path):
+    flat = imp.flatten() if imp.getOverlay() is not None else imp.duplicate()
+    def task():
+        try: FileSaver(flat).saveAsPng(path)
+        except Exception as e: IJ.log("PNG save failed %s: %s" % (path, str(e)))
+        finally: flat.flush()
+    SAVE_POOL.execute(task)
+
+# Native (pixel count, min, max) of an ROI; lets the Jython scan skip ROIs that are clearly all-negative/all-positive
+def roi_min_max(ip, roi, b=None, mask=None):
+    set_roi(ip, roi, b, mask)
+    try: st = IS.getStatistics(ip, IS.AREA | IS.MIN_MAX, None)
+    finally: ip.resetRoi()
+    return int(st.pixelCount), st.min, st.max
+
+# Positive pixels of an ROI with a known pixel count n, from the native mean of the mask under it
+def roi_count_above(pos_mask, roi, n, b=None, mask=None):
+    set_roi(pos_mask, roi, b, mask)
+    try: st = IS.getStatistics(pos_mask, IS.MEAN, None)
+    finally: pos_mask.resetRoi()
+    return int(round(st.mean * n / 255.0))
+
+NL = System.getProperty("line.separator")  # what println would write
+
+# Open a CSV for appending (64 KB buffer); header is written only when the file is new
+def open_csv(path, header):
+    f = File(path); first = not f.exists()
+    pw = PrintWriter(BufferedWriter(FileWriter(f, True), 65536))
+    if first: pw.println(header)
+    return pw
+
+_SAFE_RE = re.compile(r'[\\/:*?"<>|]+')
 
 def safe_name(s):
-    s = re.sub(r'[\\/:*?"<>|]+', '_', s)
-    return s[:180]
+    return _SAFE_RE.sub('_', s)[:180]
 
 def add_label(ov, roi, text, color=Color.white):
     if not ADD_PN_LABELS: return
@@ -127,13 +216,18 @@ def add_label(ov, roi, text, color=Color.white):
     tr.setStrokeColor(color); tr.setJustification(TextRoi.CENTER)
     ov.add(tr)
 
-def pick_dapi_from_list(img_list, patterns):
-    for im in img_list:
-        title = (im.getTitle() or "").lower()
+# The series' channels as returned by ChannelSplitter (RGB -> red/green/blue); single-channel images stay as they are
+def split_channels(imp):
+    if imp.getType() != ImagePlus.COLOR_RGB and imp.getNChannels() <= 1: return [imp]
+    return list(ChannelSplitter.split(imp))
+
+# titled: (image, lowercased title) pairs built once per series
+def pick_dapi_from_list(titled, patterns):
+    for im, title in titled:
         if any(p in title for p in patterns):
             return im
     best = None; best_mean = -1.0
-    for im in img_list:
+    for im, _ in titled:
         try:
             stats = IS.getStatistics(im.getProcessor(), IS.MEAN, im.getCalibration())
             m = float(stats.mean)
@@ -169,6 +263,8 @@ if not png_dir.exists(): png_dir.mkdirs()
 
 csv_counts = folder + File.separator + "nuclei_posneg.csv"
 csv_detail = folder + File.separator + "nuclei_posneg_perROI.csv"
+counts_header = "Image;Series;Marker;N_total;Positive;Negative;Percent_Positive"
+detail_header = "Image;Series;ROI_Index;Marker;ROI_px;PosPix;Is_Positive"
 
 from java.io import File as JFile
 files = sorted([f for f in JFile(folder).listFiles()
@@ -177,190 +273,130 @@ files = sorted([f for f in JFile(folder).listFiles()
 
 min_pos_frac = float(POS_PIXELS_FRACTION_PCT) / 100.0
 
-for f in files:
-    opts = ImporterOptions(); opts.setId(f.getAbsolutePath()); opts.setOpenAllSeries(True); opts.setVirtual(True)
-    imps = BF.openImagePlus(opts)
-
-    for sidx, imp in enumerate(imps):
-        series_name = "%s_Series%d" % (f.getName(), sidx+1) if len(imps) > 1 else f.getName()
-        IJ.run("Close All")
-        imp.setTitle(series_name); imp.show()
-        try: IJ.run(imp, "Split Channels", "")
-        except: pass
-        time.sleep(0.3)
-
-        windows = [WindowManager.getImage(i) for i in range(1, WindowManager.getImageCount()+1) if WindowManager.getImage(i) is not None]
-        dapi = pick_dapi_from_list(windows, CHANNEL_PATTERNS)
-        markers = []
-        for win in windows:
-            t = (win.getTitle() or "").lower()
-            for mkey in MARKER_CHANNEL_KEYS:
-                if mkey in t:
-                    markers.append(win); break
-
-        if dapi is None or not markers:
-            IJ.log("Missing channels in %s (DAPI and/or Markers)" % series_name)
-            for w in windows:
-                try: w.changes=False; w.close()
+# Batch mode: images are registered by title but never get windows, so Split Channels, duplicates and
+# the StarDist input skip all AWT layout/paint work. Overlays kept for display are shown after it ends.
+to_show = []
+Interpreter.batchMode = True
+# One writer per CSV for the whole run, flushed after every file
+pw_counts = open_csv(csv_counts, counts_header)
+pw_detail = open_csv(csv_detail, detail_header)
+open_pool = Executors.newSingleThreadExecutor()
+pending = open_pool.submit(OpenTask(files[0])) if files else None
+try:
+    for fidx, f in enumerate(files):
+        imps = pending.get()
+        pending = open_pool.submit(OpenTask(files[fidx+1])) if fidx+1 < len(files) else None
+
+        for sidx, imp in enumerate(imps):
+            series_name = "%s_Series%d" % (f.getName(), sidx+1) if len(imps) > 1 else f.getName()
+            IJ.run("Close All"); to_show = []
+            imp.setTitle(series_name)
+            windows = split_channels(imp)
+            titled = [(w, (w.getTitle() or "").lower()) for w in windows]
+            dapi = pick_dapi_from_list(titled, CHANNEL_PATTERNS)
+            markers = [w for w, t in titled if any(mkey in t for mkey in MARKER_CHANNEL_KEYS)]
+
+            if dapi is None or not markers:
+                IJ.log("Missing channels in %s (DAPI and/or Markers)" % series_name)
+                for w in windows:
+                    try: w.changes=False; w.close()
+                    except: pass
+                try: imp.changes=False; imp.close()
                 except: pass
-            try: imp.changes=False; imp.close()
-            except: pass
-            continue
-
-        # ===== Display DAPI channel as blue for visual reference =====
-        try:
-            disp = dapi.duplicate()
-            try: IJ.run(disp, "Blue", "")
-            except:
-                try: IJ.run(disp, "Blue LUT", "")
+                continue
+
+            # ===== Run StarDist and populate ROI Manager with detected nuclei =====
+            orig_w, orig_h = dapi.getWidth(), dapi.getHeight()
+            work = dapi.duplicate(); work.setTitle(series_name + "_work"); work.show()
+
+            if abs(SCALE_FACTOR - 1.0) > 1e-6:
+                new_w = max(1, int(round(orig_w * SCALE_FACTOR)))
+                new_h = max(1, int(round(orig_h * SCALE_FACTOR)))
+                IJ.run(work, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" %
+                       (SCALE_FACTOR, SCALE_FACTOR, new_w, new_h))
+                scaled = WindowManager.getCurrentImage()
+                try: work.changes=False; work.close()
                 except: pass
-            IJ.run(disp, "RGB Color", "")
-            disp.setTitle(series_name + "_RGBview"); disp.show()
-        except:
-            disp = None
-
-        # ===== Run StarDist and populate ROI Manager with detected nuclei =====
-        orig_w, orig_h = dapi.getWidth(), dapi.getHeight()
-        work = dapi.duplicate(); work.setTitle(series_name + "_work"); work.show()
-
-        if abs(SCALE_FACTOR - 1.0) > 1e-6:
-            new_w = max(1, int(round(orig_w * SCALE_FACTOR)))
-            new_h = max(1, int(round(orig_h * SCALE_FACTOR)))
-            IJ.run(work, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" %
-                   (SCALE_FACTOR, SCALE_FACTOR, new_w, new_h))
-            scaled = WindowManager.getCurrentImage()
-            try: work.changes=False; work.close()
-            except: pass
-            work = scaled
-
-        cmd = ("command=[de.csbdresden.stardist.StarDist2D],"
-               "args=['input':'%s','modelChoice':'%s','normalizeInput':'true',"
-               "'percentileBottom':'0.0','percentileTop':'100.0','probThresh':'%s','nmsThresh':'%s',"
-               "'outputType':'ROI Manager','nTiles':'%s','excludeBoundary':'2','verbose':'false',"
-               "'showCsbdeepProgress':'false','showProbAndDist':'false'],process=[false]") % (
-                    work.getTitle(), model, prob, nms, N_TILES)
-        IJ.run("Command From Macro", cmd); time.sleep(0.4); close_stardist_dialogs()
-
-        rm = RoiManager.getInstance() or RoiManager()
-        rois_rm = list(rm.getRoisAsArray()) if rm else []
-        if not rois_rm:
-            IJ.log("No ROIs from StarDist in %s" % series_name)
-            try: work.changes=False; work.close()
-            except: pass
-            for w in windows:
-                try: w.changes=False; w.close()
+                work = scaled
+
+            cmd = ("command=[de.csbdresden.stardist.StarDist2D],"
+                   "args=['input':'%s','modelChoice':'%s','normalizeInput':'true',"
+                   "'percentileBottom':'0.0','percentileTop':'100.0','probThresh':'%s','nmsThresh':'%s',"
+                   "'outputType':'ROI Manager','nTiles':'%s','excludeBoundary':'2','verbose':'false',"
+                   "'showCsbdeepProgress':'false','showProbAndDist':'false'],process=[false]") % (
+                        work.getTitle(), model, prob, nms, N_TILES)
+            IJ.run("Command From Macro", cmd); close_stardist_dialogs()
+
+            rm = RoiManager.getInstance() or RoiManager()
+            rois_rm = rm.getRoisAsArray() if rm else []  # Roi[] is iterated directly, no PyList copy
+            if len(rois_rm) == 0:
+                IJ.log("No ROIs from StarDist in %s" % series_name)
+                try: work.changes=False; work.close()
                 except: pass
-            try: imp.changes=False; imp.close()
-            except: pass
-            continue
-
-        # Rescale StarDist ROIs back to full-resolution coordinates if pre-scaling was used
-        if abs(SCALE_FACTOR - 1.0) > 1e-6 and (work.getWidth()!=orig_w or work.getHeight()!=orig_h):
-            sx = float(orig_w) / float(work.getWidth())
-            sy = float(orig_h) / float(work.getHeight())
-            rois_array = [rescale_roi_to_original(r, sx, sy) for r in rois_rm]
-        else:
-            rois_array = rois_rm[:]
-
-        # ===== Filter nuclei by DAPI intensity (background measured outside all ROIs) =====
-        dapi_ip = dapi.getProcessor()
-        # Build a union of all ROIs to select the background region (everything outside nuclei)
-        combined = None
-        for r in rois_array:
-            try:
-                sr = ShapeRoi(r)
-                combined = sr if combined is None else combined.or(sr)
-            except:
-                pass
-        if combined is not None:
-            dapi.setRoi(combined)
-            try: IJ.run(dapi, "Make Inverse", "")
-            except: pass
-            bg_stats = dapi.getStatistics(Measurements.MEAN | Measurements.STD_DEV)
-            dapi.deleteRoi()
-        else:
-            bg_stats = dapi.getStatistics(Measurements.MEAN | Measurements.STD_DEV)
-        bg_mean, bg_sd = float(bg_stats.mean), float(bg_stats.stdDev)
-
-        # Keep only ROIs that pass size, mean intensity, and sigma-above-background filters
-        kept_rois = []
-        for roi in rois_array:
-            area_px = roi_area_pixels(dapi_ip, roi)
-            if area_px < SIZE_MIN or area_px > SIZE_MAX: continue
-            mval = roi_mean(dapi_ip, roi)
-            if (MIN_MEAN_INTENSITY>0 and mval<MIN_MEAN_INTENSITY): continue
-            if (SIGMA_ABOVE_BG>0 and mval<bg_mean + SIGMA_ABOVE_BG*bg_sd): continue
-            kept_rois.append(roi)
-
-        rm.reset()
-        for r in kept_rois: rm.addRoi(r)
-
-        valid = list(rm.getRoisAsArray())
-        if not valid:
-            try: work.changes=False; work.close()
-            except: pass
-            for w in windows:
-                try: w.changes=False; w.close()
+                for w in windows:
+                    try: w.changes=False; w.close()
+                    except: pass
+                try: imp.changes=False; imp.close()
                 except: pass
-            try: imp.changes=False; imp.close()
-            except: pass
-            continue
-
-        # ===== Preprocess each marker channel (background subtraction and thresholds) =====
-        marker_preps = []
-        for idx, m in enumerate(markers[:len(MARKER_CHANNEL_KEYS)]):
-            proc_imp, proc_ip = preprocess_marker(m)
-            thr = float(marker_fixed[idx])
-            marker_preps.append((m, proc_imp, proc_ip, thr))
-
-        counts_header = "Image;Series;Marker;N_total;Positive;Negative;Percent_Positive"
-        detail_header = "Image;Series;ROI_Index;Marker;ROI_px;PosPix;Is_Positive"
-
-        # ===== Classify each nucleus as positive or negative per marker channel and build overlays =====
-        for midx, (m_orig, m_imp, m_ip, thr) in enumerate(marker_preps):
-            pos_count = 0; neg_count = 0; total = 0
-            ov = Overlay()
-
-            legend = TextRoi(5, 5, "Marker: %s\nGreen = Positive\nRed = Negative" % m_orig.getTitle())
-            legend.setStrokeColor(Color.white)
-            ov.add(legend)
-
-            for ridx, roi in enumerate(valid):
-                is_pos, roi_px, pospix = (False, 0, 0)
-                total += 1
-                # Count pixels in this ROI that meet or exceed the marker threshold
-                total_pix = 0; pos_pix = 0
-                for gx, gy in roi_pixel_iter(m_ip, roi):
-                    total_pix += 1
-                    if m_ip.get(gx, gy) >= thr: pos_pix += 1
-                if total_pix > 0 and float(pos_pix)/float(total_pix) >= min_pos_frac:
-                    is_pos = True
-                roi_px, pospix = total_pix, pos_pix
-
-                c = roi.clone(); c.setStrokeWidth(2)
-                if is_pos:
-                    pos_count += 1
-                    c.setStrokeColor(COLOR_POS); add_label(ov, roi, "P", COLOR_POS)
-                else:
-                    neg_count += 1
-                    c.setStrokeColor(COLOR_NEG); add_label(ov, roi, "N", COLOR_NEG)
-                ov.add(c)
-
-                detail_row = "%s;%s;%d;%s;%d;%d;%s" % (
-                    f.getName(), series_name, ridx+1, m_orig.getTitle(),
-                    int(roi_px), int(pospix), "TRUE" if is_pos else "FALSE"
-                )
-                export_counts_row(csv_detail, detail_row, detail_header)
-
-            pct = (100.0 * pos_count/float(total)) if total>0 else 0.0
-            counts_row = "%s;%s;%s;%d;%d;%d;%.6f" % (
-                f.getName(), series_name, m_orig.getTitle(),
-                int(total), int(pos_count), int(neg_count), pct
-            )
-            export_counts_row(csv_counts, counts_row, counts_header)
+                continue
 
-            # ---------- Save overlay images ----------
-            # DAPI overlay: apply blue LUT and draw positive/negative nucleus contours
+            # Rescale StarDist ROIs back to full-resolution coordinates if pre-scaling was used
+            if abs(SCALE_FACTOR - 1.0) > 1e-6 and (work.getWidth()!=orig_w or work.getHeight()!=orig_h):
+                sx = float(orig_w) / float(work.getWidth())
+                sy = float(orig_h) / float(work.getHeight())
+                rois_array = [rescale_roi_to_original(r, sx, sy) for r in rois_rm]
+            else:
+                rois_array = rois_rm
+
+            # ===== Filter nuclei by DAPI intensity (background measured outside all ROIs) =====
+            dapi_ip = dapi.getProcessor()
+            bg_stats = background_stats(dapi_ip, rois_array, dapi.getCalibration())
+            bg_mean, bg_sd = float(bg_stats.mean), float(bg_stats.stdDev)
+
+            # Keep only ROIs that pass size, mean intensity, and sigma-above-background filters
+            # Area and mean per ROI come from ImageJ's native masked statistics; bounds and masks are kept
+            # because they are the same for every marker
+            kept_rois = []; kept_area = []; geoms = []
+            for roi in rois_array:
+                b = roi.getBounds()
+                if b.width * b.height < SIZE_MIN: continue  # bounding box can't hold enough pixels
+                rmask = roi.getMask()
+                st = roi_stats(dapi_ip, roi, b, rmask)
+                area_px = int(st.pixelCount)
+                if area_px < SIZE_MIN or area_px > SIZE_MAX: continue
+                mval = float(st.mean) if area_px > 0 else 0.0
+                if (MIN_MEAN_INTENSITY>0 and mval<MIN_MEAN_INTENSITY): continue
+                if (SIGMA_ABOVE_BG>0 and mval<bg_mean + SIGMA_ABOVE_BG*bg_sd): continue
+                kept_rois.append(roi); kept_area.append(area_px); geoms.append((b, rmask))
+
+            # Leave the kept nuclei (full-resolution coordinates) in the ROI Manager, refilled once per series
+            rm.reset()
+            for r in kept_rois: rm.addRoi(r)
+
+            # ROI pixel counts, bounds and masks from the filter pass are reused for every marker
+            valid = kept_rois
+            polys = [r.getPolygon() for r in valid]
+            if not valid:
+                try: work.changes=False; work.close()
+                except: pass
+                for w in windows:
+                    try: w.changes=False; w.close()
+                    except: pass
+                try: imp.changes=False; imp.close()
+                except: pass
+                continue
+
+            # ===== Preprocess each marker channel (background subtraction and thresholds) =====
+            marker_preps = []
+            for idx, m in enumerate(markers[:len(MARKER_CHANNEL_KEYS)]):
+                proc_imp, proc_ip = preprocess_marker(m)
+                thr = float(marker_fixed[idx])
+                # Threshold every marker up front; a marker with no (or only) positive pixels needs no per-ROI counting
+                pos_mask = threshold_mask(proc_ip, thr) if NATIVE_CLASSIFY else None
+                fill = mask_fill(pos_mask) if pos_mask is not None else None
+                marker_preps.append((m, proc_imp, proc_ip, thr, pos_mask, fill))
+
+            # Blue RGB DAPI canvas is the same for every marker: build it once, only the overlay changes
             base_dapi = dapi.duplicate()
             try: IJ.run(base_dapi, "Blue", "")
             except:
@@ -369,46 +405,115 @@ for f in files:
             if ENHANCE_OVERLAY_CONTRAST:
                 IJ.run(base_dapi, "Enhance Contrast", "saturated=%.3f" % float(DAPI_OVERLAY_SAT))
             IJ.run(base_dapi, "RGB Color", "")
-            base_dapi.setOverlay(ov)
-            out_path_dapi = png_dir.getAbsolutePath() + File.separator + safe_name("%s__%s__PosNeg__DAPI.png" % (series_name, m_orig.getTitle()))
-            FileSaver(base_dapi).saveAsPng(out_path_dapi)
-            if SHOW_OVERLAYS_AT_END: base_dapi.show()
-            else:
-                try: base_dapi.changes=False; base_dapi.close()
-                except: pass
 
-            # Marker overlay: apply orange/warm LUT and draw the same positive/negative contours
-            base_marker = m_imp.duplicate()
-            applied = False
-            for lutName in ["Orange Hot", "mpl-magma", "mpl-inferno"]:
-                try: IJ.run(base_marker, lutName, ""); applied = True; break
-                except: pass
-            if not applied:
-                for lutName in ["Fire", "Red Hot"]:
+            # ===== Classify each nucleus as positive or negative per marker channel and build overlays =====
+            for midx, (m_orig, m_imp, m_ip, thr, pos_mask, fill) in enumerate(marker_preps):
+                pos_count = 0; neg_count = 0; total = 0
+                ov = Overlay()
+
+                legend = TextRoi(5, 5, "Marker: %s\nGreen = Positive\nRed = Negative" % m_orig.getTitle())
+                legend.setStrokeColor(Color.white)
+                ov.add(legend)
+
+                if pos_mask is None:
+                    m_pa = pixel_array(m_ip); mW, mH = m_ip.getWidth(), m_ip.getHeight()
+                # Detail rows for this marker are collected and written in one go
+                sb = StringBuilder(64 * len(valid))
+                # Outlines are appended (not unioned) into one path per class -> two overlay ROIs per marker
+                pos_path = GeneralPath(); neg_path = GeneralPath()
+                for ridx, roi in enumerate(valid):
+                    is_pos, roi_px, pospix = (False, 0, 0)
+                    total += 1
+                    b, rmask = geoms[ridx]
+                    # Count pixels in this ROI that meet or exceed the marker threshold
+                    if pos_mask is not None:
+                        total_pix = kept_area[ridx]
+                        if fill == 0.0 or total_pix == 0: pos_pix = 0
+                        elif fill == 1.0: pos_pix = total_pix
+                        else: pos_pix = roi_count_above(pos_mask, roi, total_pix, b, rmask)
+                    else:
+                        total_pix, vmin, vmax = roi_min_max(m_ip, roi, b, rmask)
+                        if total_pix == 0 or vmax < thr: pos_pix = 0
+                        elif vmin >= thr: pos_pix = total_pix
+                        else: total_pix, _, pos_pix = roi_scan(m_pa, mW, mH, roi, thr, b, rmask)
+                    if total_pix > 0 and float(pos_pix)/float(total_pix) >= min_pos_frac:
+                        is_pos = True
+                    roi_px, pospix = total_pix, pos_pix
+
+                    if is_pos:
+                        pos_count += 1
+                        pos_path.append(polys[ridx], False); add_label(ov, roi, "P", COLOR_POS)
+                    else:
+                        neg_count += 1
+                        neg_path.append(polys[ridx], False); add_label(ov, roi, "N", COLOR_NEG)
+
+                    detail_row = "%s;%s;%d;%s;%d;%d;%s" % (
+                        f.getName(), series_name, ridx+1, m_orig.getTitle(),
+                        int(roi_px), int(pospix), "TRUE" if is_pos else "FALSE"
+                    )
+                    sb.append(detail_row).append(NL)
+                pw_detail.write(sb.toString())
+                for path, col in ((pos_path, COLOR_POS), (neg_path, COLOR_NEG)):
+                    if path.getCurrentPoint() is None: continue
+                    sr = ShapeRoi(path); sr.setStrokeWidth(2); sr.setStrokeColor(col)
+                    ov.add(sr)
+
+                pct = (100.0 * pos_count/float(total)) if total>0 else 0.0
+                counts_row = "%s;%s;%s;%d;%d;%d;%.6f" % (
+                    f.getName(), series_name, m_orig.getTitle(),
+                    int(total), int(pos_count), int(neg_count), pct
+                )
+                pw_counts.println(counts_row)
+
+                # ---------- Save overlay images ----------
+                # DAPI overlay: apply blue LUT and draw positive/negative nucleus contours
+                base_dapi.setOverlay(ov)
+                out_path_dapi = png_dir.getAbsolutePath() + File.separator + safe_name("%s__%s__PosNeg__DAPI.png" % (series_name, m_orig.getTitle()))
+                save_png_async(base_dapi, out_path_dapi)
+                if SHOW_OVERLAYS_AT_END: to_show.append(base_dapi.duplicate())
+
+                # Marker overlay: apply orange/warm LUT and draw the same positive/negative contours
+                base_marker = m_imp.duplicate()
+                applied = False
+                for lutName in ["Orange Hot", "mpl-magma", "mpl-inferno"]:
                     try: IJ.run(base_marker, lutName, ""); applied = True; break
                     except: pass
-            if ENHANCE_OVERLAY_CONTRAST:
-                IJ.run(base_marker, "Enhance Contrast", "saturated=%.3f" % float(MARKER_OVERLAY_SAT))
-            IJ.run(base_marker, "RGB Color", "")
-            base_marker.setOverlay(ov)
-            out_path_marker = png_dir.getAbsolutePath() + File.separator + safe_name("%s__%s__PosNeg__MARKER.png" % (series_name, m_orig.getTitle()))
-            FileSaver(base_marker).saveAsPng(out_path_marker)
-            if SHOW_OVERLAYS_AT_END: base_marker.show()
-            else:
-                try: base_marker.changes=False; base_marker.close()
-                except: pass
+                if not applied:
+                    for lutName in ["Fire", "Red Hot"]:
+                        try: IJ.run(base_marker, lutName, ""); applied = True; break
+                        except: pass
+                if ENHANCE_OVERLAY_CONTRAST:
+                    IJ.run(base_marker, "Enhance Contrast", "saturated=%.3f" % float(MARKER_OVERLAY_SAT))
+                IJ.run(base_marker, "RGB Color", "")
+                base_marker.setOverlay(ov)
+                out_path_marker = png_dir.getAbsolutePath() + File.separator + safe_name("%s__%s__PosNeg__MARKER.png" % (series_name, m_orig.getTitle()))
+                save_png_async(base_marker, out_path_marker)
+                if SHOW_OVERLAYS_AT_END: to_show.append(base_marker)
+                else:
+                    try: base_marker.changes=False; base_marker.close()
+                    except: pass
 
-        # Close all temporary images for this series and free memory
-        try: work.changes=False; work.close()
-        except: pass
-        for (_, m_imp, _, _) in marker_preps:
-            try: m_imp.changes=False; m_imp.close()
+            # Close all temporary images for this series and free memory
+            try: work.changes=False; work.close()
             except: pass
-        for w in windows:
-            try: w.changes=False; w.close()
+            try: base_dapi.changes=False; base_dapi.close()
             except: pass
-        try: imp.changes=False; imp.close()
-        except: pass
+            for (m_orig, m_imp, _, _, _, _) in marker_preps:
+                if m_imp is m_orig: continue
+                try: m_imp.changes=False; m_imp.close()
+                except: pass
+            for w in windows:
+                try: w.changes=False; w.close()
+                except: pass
+            try: imp.changes=False; imp.close()
+            except: pass
+        pw_counts.flush(); pw_detail.flush()
+finally:
+    open_pool.shutdownNow()
+    SAVE_POOL.shutdown(); SAVE_POOL.awaitTermination(1, TimeUnit.HOURS)
+    pw_counts.close(); pw_detail.close()
+    Interpreter.batchMode = False
+for im in to_show: im.show()
 
 IJ.log("Done. CSVs written:\n - " + csv_counts + "\n - " + csv_detail + "\nPNGs -> " + png_dir.getAbsolutePath())
 
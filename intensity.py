@@ -1,9 +1,23 @@
-from ij import IJ, WindowManager
+from ij import IJ, ImagePlus
+from ij.plugin import ChannelSplitter, ContrastEnhancer, LutLoader
 from ij.io import DirectoryChooser, FileSaver
+from ij.macro import Interpreter
 from java.io import File, FileWriter, BufferedWriter, PrintWriter
+from ij.process import ImageStatistics, ImageProcessor, Blitter, AutoThresholder
+from ij.measure import Measurements
+from java.lang import Math, Float, Integer, Runtime
+from java.util import HashMap, Locale
+from java.nio.file import Files, Paths
+from java.nio.charset import Charset
+from java.util.concurrent import Callable, Executors
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
-import time
+from loci.common import NIOFileHandle
+from loci.formats import ImageReader
+import math, re
+
+# Bio-Formats reads through 16 KB NIO buffers instead of the 1 MB default, which is faster to set up per file
+NIOFileHandle.setDefaultBufferSize(16384)
 
 # =====================================================================
 #                             SETTINGS
@@ -78,23 +92,98 @@ else:
     ROLLING_REPEAT = 0
     MEDIAN_RADIUS = 0
 
+# Optional fast approximation: subtract a Gaussian blur (sigma = rolling radius) instead of the rolling ball
+USE_DOG_BACKGROUND = False
+
 # =====================================================================
-#            Export function: append one measurement row to the CSV
+#            Export functions: one open writer per CSV, one row per call
 # =====================================================================
-def export_intensity(
-    image_name, channel_name, pos_pixels, mean_int,
-    integrated_int, nuclei_count, normalized_intensity, csv_path
-):
+def open_csv(csv_path):
+    # Appends through a 64 KB buffer; the header is written only when the file is new
     f = File(csv_path)
     first = not f.exists()
-    pw = PrintWriter(BufferedWriter(FileWriter(f, True)))
+    pw = PrintWriter(BufferedWriter(FileWriter(f, True), 65536))
     if first:
         pw.println("Image,Channel,Positive_Pixels,Mean_Intensity,Integrated_Intensity,Nuclei_Count,Normalized_Intensity")
-    pw.println("%s,%s,%d,%.3f,%.3f,%d,%.6f" % (
-        image_name, channel_name, pos_pixels, mean_int,
-        integrated_int, nuclei_count, normalized_intensity
-    ))
-    pw.close()
+    return pw
+
+# Rows are formatted by java.util.Formatter straight into the writer's buffer (ROOT locale keeps
+# the decimal point regardless of the Fiji locale)
+def export_intensity(
+    pw, image_name, channel_name, pos_pixels, mean_int,
+    integrated_int, nuclei_count, normalized_intensity
+):
+    pw.printf(Locale.ROOT, "%s,%s,%d,%.3f,%.3f,%d,%.6f%n",
+        image_name, channel_name, int(pos_pixels), float(mean_int),
+        float(integrated_int), int(nuclei_count), float(normalized_intensity)
+    )
+
+# =====================================================================
+#   Series access: count once, then import one series at a time
+# =====================================================================
+def count_series(path):
+    r = ImageReader()
+    try:
+        r.setId(path); return r.getSeriesCount()
+    finally: r.close()
+
+def open_series(path, sidx):
+    opts = ImporterOptions()
+    opts.setId(path)
+    opts.clearSeries()
+    opts.setSeriesOn(sidx, True)
+    opts.setVirtual(True)
+    opts.setQuiet(True)
+    return BF.openImagePlus(opts)[0]
+
+# =====================================================================
+#   Channels of a series (single-channel images are kept as they are)
+# =====================================================================
+def split_channels(imp):
+    if imp.getType() != ImagePlus.COLOR_RGB and imp.getNChannels() <= 1: return [imp]
+    return list(ChannelSplitter.split(imp))
+
+# =====================================================================
+#   Lower auto-threshold of a channel
+# =====================================================================
+_AUTO_METHODS = set(AutoThresholder.getMethods())
+
+def auto_threshold(imp, method_str, hist=None):
+    # 8-bit: the method runs straight on the 256-bin histogram, giving the same lower bound
+    # setAutoThreshold would (threshold+1 for a dark background) without touching the LUT
+    ip = imp.getProcessor()
+    parts = method_str.split()
+    if ip.getBitDepth() == 8 and not ip.isInvertedLut() and parts and parts[0] in _AUTO_METHODS:
+        if "dark" not in [p.lower() for p in parts[1:]]: return 0.0
+        return float(min(255, AutoThresholder().getThreshold(parts[0], hist if hist is not None else ip.getHistogram()) + 1))
+    IJ.setAutoThreshold(imp, method_str)
+    return float(ip.getMinThreshold())
+
+# =====================================================================
+#   Count and sum of pixels above a threshold, from native statistics
+# =====================================================================
+def measure_above(ip, th, hist=None):
+    # 8-bit: one native histogram pass (or the one the threshold came from), then a reduction
+    # over the (at most 256) bins above th
+    if ip.getBitDepth() == 8:
+        if hist is None: hist = ip.getHistogram()
+        cnt = 0; sum_int = 0.0
+        for v in xrange(max(0, int(math.floor(th)) + 1), len(hist)):
+            c = hist[v]
+            if c:
+                cnt += c; sum_int += v * c
+        return cnt, sum_int
+    # 16/32-bit: native limit-to-threshold statistics instead of reducing up to 65536 bins in Jython;
+    # the lower bound keeps th itself excluded (next integer, or next float up)
+    lower = math.floor(th) + 1 if ip.getBitDepth() == 16 else Math.nextUp(float(th))
+    ip.setThreshold(lower, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+    try: st = ImageStatistics.getStatistics(ip, Measurements.AREA | Measurements.MEAN | Measurements.LIMIT, None)
+    finally: ip.resetThreshold()
+    cnt = int(st.pixelCount)
+    return cnt, (float(st.mean) * cnt if cnt > 0 else 0.0)
+
+# Series suffix the counting scripts append to multi-series image names
+_SERIES_RE = re.compile(r'_Series\d+$')
 
 # =====================================================================
 #      Select input folder and read nucleus counts CSV for normalization
@@ -109,21 +198,25 @@ counts_filename = IJ.getString(
     "Name of nucleus-count CSV (leave empty to skip normalization)",
     "nuclei_counts.csv"
 )
-counts_list = []
+# Nucleus counts per input file, keyed by file name: per-series rows ("<file>_SeriesN") are summed
+# into their file, the TOTAL row of the counting script is ignored
+nuclei_counts_map = HashMap()
 if counts_filename:
     counts_path = folder + File.separator + counts_filename
     try:
         f_counts = File(counts_path)
         if f_counts.exists():
-            with open(counts_path, 'r') as fp:
-                for line in fp:
-                    line = line.strip()
-                    if not line or line.lower().startswith("image"): continue
-                    parts = line.split(',')
-                    try:
-                        counts_list.append(int(float(parts[-1].strip())))
-                    except:
-                        counts_list.append(0)
+            # One bulk read in the charset the counting scripts' PrintWriter wrote with
+            for line in Files.readAllLines(f_counts.toPath(), Charset.defaultCharset()):
+                line = line.strip()
+                if not line or line.lower().startswith("image"): continue
+                parts = line.split(',')
+                img = _SERIES_RE.sub("", ",".join(parts[:-1]).strip())
+                if img == "TOTAL_ALL_IMAGES": continue
+                try: n = int(float(parts[-1].strip()))
+                except: n = 0
+                prev = nuclei_counts_map.get(img)
+                nuclei_counts_map.put(img, Integer(n + (prev.intValue() if prev else 0)))
         else:
             IJ.log("Note: file '%s' not found - normalization skipped." % counts_filename)
     except Exception as err:
@@ -137,130 +230,142 @@ heatmap_dir = None
 if use_heatmap:
     heatmap_dir = File(folder + File.separator + "heatmaps")
     if not heatmap_dir.exists(): heatmap_dir.mkdir()
+    FIRE_LUT = LutLoader.getLut("fire")
 
 csv_file = folder + File.separator + "intensity_measurements.csv"
 well_csv_file = folder + File.separator + "intensity_measurements_per_well.csv"
 
-# Load all supported image files from the folder in alphabetical order
-files = sorted(
-    [f for f in File(folder).listFiles()
-     if f.isFile() and f.getName().lower().endswith((".tif", ".tiff", ".png", ".jpg", ".lif", ".nd2"))],
-    key=lambda f: f.getName().lower()
-)
+# Load all supported image files from the folder in alphabetical order; the extension filter is a
+# case-insensitive glob evaluated by the directory stream itself
+IMAGE_GLOB = "*.{[tT][iI][fF],[tT][iI][fF][fF],[pP][nN][gG],[jJ][pP][gG],[lL][iI][fF],[nN][dD]2}"
+ds = Files.newDirectoryStream(Paths.get(folder), IMAGE_GLOB)
+try:
+    files = sorted([p.toFile() for p in ds if Files.isRegularFile(p)], key=lambda f: f.getName().lower())
+finally: ds.close()
 
 # =====================================================================
-#          Main loop: measure marker intensity for each image file
+#          Per-file measurement (runs on the worker pool)
 # =====================================================================
-for idx, f in enumerate(files):
+def measure_file(f):
     # Retrieve the pre-loaded nucleus count for this file, if available
-    file_nuclei_count = counts_list[idx] if idx < len(counts_list) else 0
+    nv = nuclei_counts_map.get(f.getName())
+    file_nuclei_count = nv.intValue() if nv else 0
 
     total_positive = 0
     total_integrated = 0.0
     total_nuclei = file_nuclei_count
+    rows = []
 
-    opts = ImporterOptions()
-    opts.setId(f.getAbsolutePath())
-    opts.setOpenAllSeries(True)
-    opts.setVirtual(True)
-    imps = BF.openImagePlus(opts)
-
-    for sidx, imp in enumerate(imps):
+    # Series are imported one at a time through a single reader's series count
+    path = f.getAbsolutePath()
+    for sidx in range(count_series(path)):
+        imp = open_series(path, sidx)
         series_name_raw = "%s_Series%d" % (f.getName(), sidx+1)
         imp.setTitle(series_name_raw)
-        imp.show()
-
-        IJ.run(imp, "Split Channels", "")
-        time.sleep(0.5)
-
-        # Find open channel windows whose titles match the configured marker patterns
-        marker_channels = []
-        for i in range(1, WindowManager.getImageCount()+1):
-            win = WindowManager.getImage(i)
-            if not win: continue
-            title = win.getTitle().lower()
-            if any(mkey in title for mkey in MARKER_CHANNEL_KEYS):
-                marker_channels.append(win)
+        # Marker channels, matched on the titles ChannelSplitter gives them
+        marker_channels = [ch for ch in split_channels(imp)
+                           if any(mkey in ch.getTitle().lower() for mkey in MARKER_CHANNEL_KEYS)]
 
         for marker in marker_channels:
-            chan = marker.duplicate()
-            chan.show()
-            
+            # ChannelSplitter already returned a private copy of the channel: process it in place
+            chan = marker
+        
 
+            # Median, Subtract Background and the DoG all filter this processor in place
+            ip = chan.getProcessor()
             if APPLY_BACKGROUND:
                 if MEDIAN_RADIUS>0:
                     IJ.run(chan, "Median...", "radius=%d"%int(MEDIAN_RADIUS))
-                for _ in range(max(1, ROLLING_REPEAT)):
-                    IJ.run(chan, "Subtract Background...", "rolling=%d"%int(ROLLING_RADIUS))
+                if USE_DOG_BACKGROUND:
+                    # Separable Gaussian is linear in the radius, the rolling ball is not
+                    bg = ip.duplicate(); bg.blurGaussian(float(ROLLING_RADIUS))
+                    ip.copyBits(bg, 0, 0, Blitter.SUBTRACT)
+                else:
+                    for _ in range(max(1, ROLLING_REPEAT)):
+                        IJ.run(chan, "Subtract Background...", "rolling=%d"%int(ROLLING_RADIUS))
 
+            # 8-bit: one histogram serves both the auto threshold and the measurement
+            hist = ip.getHistogram() if ip.getBitDepth() == 8 else None
             if USE_FIXED_THRESHOLD:
                 th_val = float(FIXED_THRESHOLD)
             else:
-                IJ.setAutoThreshold(chan, THRESHOLD_METHOD)
-                ip = chan.getProcessor()
-                th_val = float(ip.getMinThreshold())
+                th_val = auto_threshold(chan, THRESHOLD_METHOD, hist)
                 if th_val != th_val: th_val = 0.0
             eff_th = th_val * float(THRESHOLD_FACTOR)
             # --- Save heatmaps if requested ---
             if use_heatmap and heatmap_dir is not None:
                 base = ("%s__%s" % (series_name_raw, marker.getTitle())).replace(" ", "_")
                 try:
-                    # Save false-color heatmap using the Fire LUT for visual inspection
-                    hm = chan.duplicate()
-                    IJ.run(hm, "8-bit", "")
-                    IJ.run(hm, "Enhance Contrast", "saturated=0.35")
-                    IJ.run(hm, "Fire", "")
-                    IJ.run(hm, "RGB Color", "")
-                    FileSaver(hm).saveAsPng(heatmap_dir.getAbsolutePath() + File.separator + base + "_heatmap.png")
-                    hm.changes = False; hm.close()
-                    
-                    # Binary mask (> eff_th)
-                    mask = chan.duplicate()
-                    IJ.setThreshold(mask, float(eff_th), 1e12)
-                    IJ.run(mask, "Convert to Mask", "")
-                    FileSaver(mask).saveAsPng(heatmap_dir.getAbsolutePath() + File.separator + base + "_mask.png")
-                    mask.changes = False; mask.close()
+                    # Save false-color heatmap using the Fire LUT for visual inspection: processor calls
+                    # on one 8-bit copy (Enhance Contrast only sets the display range RGB conversion applies)
+                    hm = ip.convertToByte(True) if ip.getBitDepth() != 8 else ip.duplicate()
+                    # LUT first: setLut resets a ByteProcessor's display range, which would undo the stretch
+                    hm.setLut(FIRE_LUT)
+                    ContrastEnhancer().stretchHistogram(hm, 0.35)
+                    FileSaver(ImagePlus(base + "_heatmap", hm.convertToRGB())).saveAsPng(heatmap_dir.getAbsolutePath() + File.separator + base + "_heatmap.png")
+
+                    # Binary mask (>= eff_th), built straight from the thresholded channel
+                    ip.setThreshold(float(eff_th), Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+                    try: mask = ip.createMask()
+                    finally: ip.resetThreshold()
+                    FileSaver(ImagePlus(base + "_mask", mask)).saveAsPng(heatmap_dir.getAbsolutePath() + File.separator + base + "_mask.png")
                 except Exception as _err:
                     IJ.log("Warning: could not save heatmap: %s" % str(_err))
             # --- End heatmap save ---
 
 
-            ip = chan.getProcessor()
-            w,h = ip.getWidth(), ip.getHeight()
-            sum_int = 0.0
-            cnt = 0
-            for y in range(h):
-                for x in range(w):
-                    v = ip.get(x,y)
-                    if v>eff_th:
-                        sum_int += v
-                        cnt += 1
+            cnt, sum_int = measure_above(ip, eff_th, hist)
 
             mean_int = (sum_int/cnt) if cnt>0 else 0.0
             integ_int = sum_int
             nuclei_count = file_nuclei_count
             norm_int = (integ_int/float(nuclei_count)) if nuclei_count>0 else 0.0
 
-            export_intensity(
+            rows.append((
                 series_name_raw, marker.getTitle(), cnt, mean_int,
-                integ_int, nuclei_count, norm_int, csv_file
-            )
+                integ_int, nuclei_count, norm_int
+            ))
 
             total_positive += cnt
             total_integrated += integ_int
 
             chan.changes = False
-            marker.changes = False
             chan.close()
-            marker.close()
 
-        WindowManager.closeAllWindows()
+        imp.changes = False
+        imp.close()
 
     # Aggregate all series into a per-well summary row
     well_mean = (total_integrated/total_positive) if total_positive>0 else 0.0
     well_norm = (total_integrated/total_nuclei) if total_nuclei>0 else 0.0
-    export_intensity(
-        f.getName(), "AllSeries", total_positive,
-        well_mean, total_integrated, total_nuclei, well_norm,
-        well_csv_file
-    )
+    well_row = (f.getName(), "AllSeries", total_positive,
+                well_mean, total_integrated, total_nuclei, well_norm)
+    return rows, well_row
+
+# Files are measured in parallel: every image here is private to its file (nothing is shown or looked
+# up by title), and the rows come back to the main thread, which writes them in file order
+class FileTask(Callable):
+    def __init__(self, f): self.f = f
+    def call(self): return measure_file(self.f)
+
+N_WORKERS = max(1, min(4, Runtime.getRuntime().availableProcessors()))
+
+# =====================================================================
+#          Main loop: measure marker intensity for each image file
+# =====================================================================
+# Batch mode: the series, its split channels and the working copies never get windows
+Interpreter.batchMode = True
+pw_intensity = open_csv(csv_file)
+pw_well = open_csv(well_csv_file)
+pool = Executors.newFixedThreadPool(N_WORKERS)
+try:
+    futures = [pool.submit(FileTask(f)) for f in files]
+    for fut in futures:
+        rows, well_row = fut.get()
+        for row in rows: export_intensity(pw_intensity, *row)
+        export_intensity(pw_well, *well_row)
+        pw_intensity.flush(); pw_well.flush()
+finally:
+    pool.shutdownNow()
+    pw_intensity.close(); pw_well.close()
+    Interpreter.batchMode = False
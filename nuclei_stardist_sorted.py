@@ -1,16 +1,23 @@
+#@ CommandService command
 from ij import IJ, WindowManager, ImagePlus
 from ij.io import DirectoryChooser, FileSaver
 from ij.plugin.frame import RoiManager
-from ij.gui import Overlay, TextRoi, ShapeRoi
+from ij.plugin import ChannelSplitter
+from ij.macro import Interpreter
+from ij.gui import Overlay, TextRoi, PolygonRoi, Roi, Wand
 from java.io import File, FileWriter, BufferedWriter, PrintWriter
-from java.lang import Double
-from java.awt import Color
+from java.lang import Double, Runtime
+from java.awt import Color, Rectangle
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
-from ij.measure import ResultsTable, Measurements
-from ij.plugin.filter import ParticleAnalyzer
-from ij.process import ImageStatistics as IS
-import time, re, math
+from loci.common import NIOFileHandle
+from loci.formats import ImageReader
+from ij.process import ImageStatistics as IS, ByteProcessor
+from de.csbdresden.stardist import StarDist2D
+import re, math, jarray
+
+# 16 KB NIO buffers: opening a file no longer allocates the 1 MB Bio-Formats default
+NIOFileHandle.setDefaultBufferSize(16384)
 
 # === User settings ===
 model                = IJ.getString("StarDist model", "Versatile (fluorescent nuclei)")
@@ -37,20 +44,18 @@ QC_SAT_PCT           = IJ.getNumber("QC overlay contrast saturation (%)", 1.0) i
 QC_STROKE_WIDTH      = IJ.getNumber("Overlay stroke width (px)", 2)
 QC_COLOR             = Color(255, 0, 0)  # red contours
 
+_SAFE_RE = re.compile(r'[\\/:*?"<>|]+')
+
 def safe_name(s):
-    s = re.sub(r'[\\/:*?"<>|]+', '_', s)
-    return s[:180]
-
-def list_open_images():
-    imgs = []
-    for i in range(1, WindowManager.getImageCount() + 1):
-        im = WindowManager.getImage(i)
-        if im is not None:
-            imgs.append(im)
-    return imgs
-
-def pick_dapi_image(patterns):
-    imgs = list_open_images()
+    return _SAFE_RE.sub('_', s)[:180]
+
+# Channels of a series straight from ChannelSplitter (RGB -> red/green/blue); a single-channel image is
+# kept as-is, just like Split Channels leaves it
+def split_channels(imp):
+    if imp.getType() != ImagePlus.COLOR_RGB and imp.getNChannels() <= 1: return [imp]
+    return list(ChannelSplitter.split(imp))
+
+def pick_dapi_image(patterns, imgs):
     for im in imgs:
         title = (im.getTitle() or "").lower()
         if any(p in title for p in patterns):
@@ -68,14 +73,70 @@ def pick_dapi_image(patterns):
             best_mean = m; best = im
     return best if best is not None else (imgs[0] if imgs else None)
 
-def close_stardist_dialogs():
-    for w in WindowManager.getNonImageWindows():
-        try:
-            title = w.getTitle()
-            if title and title.lower().startswith("stardist"):
-                w.dispose()
-        except:
-            pass
+# Rescale ROI coordinates from the downscaled working image back to original image size
+def rescale_roi_to_original(roi, sx, sy):
+    fp = roi.getFloatPolygon()
+    if fp is None or fp.npoints == 0:
+        b = roi.getBounds()
+        nx = int(round(b.x * sx)); ny = int(round(b.y * sy))
+        nw = max(1, int(round(b.width * sx))); nh = max(1, int(round(b.height * sy)))
+        return Roi(nx, ny, nw, nh)
+    xs = jarray.array([fp.xpoints[i] * sx for i in range(fp.npoints)], 'f')
+    ys = jarray.array([fp.ypoints[i] * sy for i in range(fp.npoints)], 'f')
+    return PolygonRoi(xs, ys, fp.npoints, Roi.POLYGON)
+
+# Mean/SD of everything outside the ROIs: the ROIs are filled into one 8-bit mask whose inverse is the
+# background mask (no ROIs -> whole image), so there is no ShapeRoi union to build
+def background_stats(ip, rois, cal=None):
+    W, H = ip.getWidth(), ip.getHeight()
+    fg = ByteProcessor(W, H); fg.setValue(255)
+    for r in rois:
+        try: fg.fill(r)
+        except: pass
+    fg.invert()
+    ip.setRoi(Rectangle(0, 0, W, H)); ip.setMask(fg)
+    try: return IS.getStatistics(ip, IS.MEAN | IS.STD_DEV, cal)
+    finally: ip.resetRoi()
+
+# Circularity 4*pi*area/perimeter^2 (as reported by ParticleAnalyzer, capped at 1); the perimeter comes
+# from the traced pixel outline of the ROI mask, so Mean_Roundness matches ParticleAnalyzer-based runs
+def traced_perimeter(roi):
+    mask = roi.getMask()
+    if mask is None:
+        b = roi.getBounds(); return 2.0 * (b.width + b.height)
+    pix = mask.getPixels(); w = mask.getWidth()
+    start = next((i for i in xrange(len(pix)) if pix[i] != 0), -1)
+    if start < 0: return 0.0
+    wand = Wand(mask); wand.autoOutline(start % w, start // w, 255.0, 255.0, Wand.LEGACY_MODE)
+    return PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI).getLength()
+
+def circ_from_roi(roi, area=None):
+    try:
+        if area is None: area = roi.getStatistics().pixelCount
+        per = traced_perimeter(roi)
+        if per > 0 and area > 0:
+            return min(1.0, 4.0*math.pi*float(area)/(per*per))
+    except: pass
+    return Double.NaN
+
+# Virtual stacks only pay off when the file may not fit in RAM; every plane is split and read here anyway
+def use_virtual(f):
+    return f.length() > Runtime.getRuntime().maxMemory() // 4
+
+# Series are counted once and then imported one by one, so a multi-position file never has
+# all of its series initialized at the same time; one ImageReader (with its per-format readers)
+# is built for the whole run and only releases the file between calls
+_series_reader = ImageReader()
+def count_series(path):
+    try:
+        _series_reader.setId(path); return _series_reader.getSeriesCount()
+    finally: _series_reader.close(True)
+
+def open_series(f, sidx):
+    opts = ImporterOptions()
+    opts.setId(f.getAbsolutePath()); opts.clearSeries(); opts.setSeriesOn(sidx, True)
+    opts.setVirtual(use_virtual(f)); opts.setQuiet(True)
+    return BF.openImagePlus(opts)[0]
 
 # Pick folder
 dc     = DirectoryChooser("Select folder with images")
@@ -92,207 +153,170 @@ qc_dir = File(folder + File.separator + "QC_Overlays")
 if SAVE_QC_OVERLAYS and not qc_dir.exists():
     qc_dir.mkdirs()
 
-def export_counts(image_name, total_count, path):
+# Open a CSV for appending (64 KB buffer); header is written only when the file is new
+def open_csv(path, header):
     f = File(path); first = not f.exists()
-    pw = PrintWriter(BufferedWriter(FileWriter(f, True)))
-    try:
-        if first: pw.println("Image,Total_Nuclei_Count")
-        pw.println("%s,%d" % (image_name, total_count))
-    finally: pw.close()
+    pw = PrintWriter(BufferedWriter(FileWriter(f, True), 65536))
+    if first: pw.println(header)
+    return pw
 
-def export_morphology(image_name, mean_area, mean_roundness, path):
-    f = File(path); first = not f.exists()
-    pw = PrintWriter(BufferedWriter(FileWriter(f, True)))
-    try:
-        if first: pw.println("Image,Mean_Area,Mean_Roundness")
-        pw.println("%s,%.2f,%.4f" % (image_name, mean_area, mean_roundness))
-    finally: pw.close()
+def export_counts(pw, image_name, total_count):
+    pw.println("%s,%d" % (image_name, total_count))
 
-grand_total = 0
+def export_morphology(pw, image_name, mean_area, mean_roundness):
+    pw.println("%s,%.2f,%.4f" % (image_name, mean_area, mean_roundness))
 
-# === Batch over files ===
-for f in File(folder).listFiles():
-    if not f.isFile(): continue
-    name = f.getName().lower()
-    if not name.endswith((".tif", ".tiff", ".png", ".jpg", ".jpeg", ".lif", ".nd2")): continue
-
-    opts = ImporterOptions()
-    opts.setId(f.getAbsolutePath()); opts.setOpenAllSeries(True); opts.setVirtual(True)
-    imps = BF.openImagePlus(opts)
-
-    for idx, imp in enumerate(imps):
-        title = "%s_Series%d" % (f.getName(), idx + 1) if len(imps) > 1 else f.getName()
-        IJ.run("Close All")
-        imp.setTitle(title); imp.show()
-        print("→ Processing: %s" % title)
-
-        if imp.getType() == ImagePlus.COLOR_RGB:
-            IJ.run(imp, "Split Channels", "")
-        else:
-            try: IJ.run(imp, "Split Channels", "")
-            except: pass
-        time.sleep(0.3)
+grand_total = 0
 
-        dapi = pick_dapi_image(channel_patterns)
-        if not dapi:
-            IJ.error("No suitable channel/image found in %s" % title)
-            IJ.run("Close All"); continue
-        IJ.selectWindow(dapi.getTitle())
+# Supported image files, listed once and processed in alphabetical order
+files = sorted([f for f in File(folder).listFiles()
+                if f.isFile() and f.getName().lower().endswith((".tif", ".tiff", ".png", ".jpg", ".jpeg", ".lif", ".nd2"))],
+               key=lambda f: f.getName().lower())
 
-        # --- RGB display window (blue DAPI) ---
-        disp = dapi.duplicate()
-        try: IJ.run(disp, "Blue", "")
-        except:
-            try: IJ.run(disp, "Blue LUT", "")
-            except: pass
-        IJ.run(disp, "RGB Color", "")
-        disp.setTitle(title + "_RGBview")
-        disp.show()
-
-        # ===== Pre-processing on grayscale 'work' (no background subtraction) =====
-        orig_w, orig_h = dapi.getWidth(), dapi.getHeight()
-        work = dapi.duplicate(); work.setTitle(title + "_work"); work.show()
-
-        if abs(SCALE_FACTOR - 1.0) > 1e-6:
-            new_w = max(1, int(round(orig_w * SCALE_FACTOR)))
-            new_h = max(1, int(round(orig_h * SCALE_FACTOR)))
-            IJ.run(work, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" %
-                   (SCALE_FACTOR, SCALE_FACTOR, new_w, new_h))
-            scaled = WindowManager.getCurrentImage()
-            try: work.changes=False; work.close()
-            except: pass
-            work = scaled
-
-        # StarDist on 'work'
-        cmd = ("command=[de.csbdresden.stardist.StarDist2D],"
-               "args=['input':'%s','modelChoice':'%s','normalizeInput':'true',"
-               "'percentileBottom':'0.0','percentileTop':'100.0','probThresh':'%s','nmsThresh':'%s',"
-               "'outputType':'Label Image','nTiles':'%d','excludeBoundary':'2','verbose':'false',"
-               "'showCsbdeepProgress':'false','showProbAndDist':'false'],process=[false]" %
-               (work.getTitle(), model, prob, nms, n_tiles))
-        IJ.run("Command From Macro", cmd)
-        time.sleep(1)
-
-        for _ in range(3):
-            close_stardist_dialogs(); time.sleep(0.1)
-
-        # Find label image
-        label = None
-        for i in range(1, WindowManager.getImageCount() + 1):
-            im = WindowManager.getImage(i)
-            if im and "label image" in (im.getTitle() or "").lower():
-                label = im; break
-        if not label:
-            IJ.error("Label image not found for %s" % title)
-            IJ.run("Close All"); continue
-
-        # Scale back to original if needed
-        if abs(SCALE_FACTOR - 1.0) > 1e-6 and (label.getWidth() != orig_w or label.getHeight() != orig_h):
-            IJ.selectWindow(label.getTitle())
-            IJ.run(label, "Scale...", "x=%f y=%f width=%d height=%d interpolation=None create" %
-                   (1.0/SCALE_FACTOR, 1.0/SCALE_FACTOR, orig_w, orig_h))
-            scaled_back = WindowManager.getCurrentImage()
-            try: label.changes=False; label.close()
-            except: pass
-            label = scaled_back
-
-        IJ.selectWindow(label.getTitle()); label.show()
-
-        # ROI extraction
-        rm = RoiManager.getInstance() or RoiManager()
-        rm.reset()
-        IJ.run(label, "Connected Components Labeling", "connectivity=4")
-        IJ.setThreshold(label, 1, Double.POSITIVE_INFINITY)
-        rt = ResultsTable()
-        pa = ParticleAnalyzer(
-            ParticleAnalyzer.ADD_TO_MANAGER | ParticleAnalyzer.SHOW_MASKS,
-            Measurements.AREA | Measurements.CIRCULARITY | Measurements.RECT | Measurements.SHAPE_DESCRIPTORS,
-            rt, size_min, size_max
-        )
-        pa.analyze(label)
-
-        # ===== NEW: compute background (outside nuclei) and filter ROIs =====
-        rois_array = rm.getRoisAsArray()
-        # Build union of ROIs for background selection
-        combined = None
-        for r in rois_array:
-            sr = ShapeRoi(r)
-            combined = sr if combined is None else combined.or(sr)
-
-        if combined is not None:
-            dapi.setRoi(combined)
-            IJ.run(dapi, "Make Inverse", "")
-            bg_stats = dapi.getStatistics(Measurements.MEAN | Measurements.STD_DEV)
-            dapi.deleteRoi()
-        else:
-            bg_stats = dapi.getStatistics(Measurements.MEAN | Measurements.STD_DEV)
-
-        bg_mean, bg_sd = bg_stats.mean, bg_stats.stdDev
-
-        kept_rois, areas_kept, round_kept = [], [], []
-        for i, roi in enumerate(rois_array):
-            dapi.setRoi(roi)
-            rs = dapi.getStatistics(Measurements.MEAN)
-            roi_mean = rs.mean
-            dapi.deleteRoi()
-
-            pass_abs   = (MIN_MEAN_INTENSITY <= 0) or (roi_mean >= MIN_MEAN_INTENSITY)
-            pass_sigma = (SIGMA_ABOVE_BG <= 0) or (roi_mean >= bg_mean + SIGMA_ABOVE_BG * bg_sd)
-
-            if pass_abs and pass_sigma:
-                kept_rois.append(roi)
-                areas_kept.append(rt.getValue("Area", i))
-                round_kept.append(rt.getValue("Circ.", i))
-
-        # Replace ROIs with filtered set
-        rm.reset()
-        for r in kept_rois:
-            rm.addRoi(r)
-
-        # Recompute summary on kept ROIs
-        count = len(kept_rois)
-        if count > 0:
-            mean_area  = sum(areas_kept) / count
-            mean_round = sum(round_kept) / count
-        else:
-            mean_area = 0.0; mean_round = 0.0
-
-        # CSV export
-        export_counts(title, count, csv_counts)
-        export_morphology(title, mean_area, mean_round, csv_morphology)
-        print("→ %s: Count=%d" % (label.getTitle(), count))
-
-        # --- Overlay on RGB view & optional save ---
-        if rm.getCount() > 0:
-            ov = Overlay()
-            legend = TextRoi(5, 5, "QC: detected nuclei\nContours in RED")
-            legend.setStrokeColor(Color.white)
-            ov.add(legend)
-            for roi in rm.getRoisAsArray():
-                c = roi.clone()
-                c.setStrokeWidth(int(QC_STROKE_WIDTH))
-                c.setStrokeColor(QC_COLOR)
-                ov.add(c)
-            disp.setOverlay(ov); disp.updateAndDraw()
-
-            if SAVE_QC_OVERLAYS:
-                save_copy = disp.duplicate()
+# === Batch over files ===
+# Batch mode: channels, duplicates and the StarDist input are registered by title but never get windows,
+# so splitting and duplicating skip all AWT layout/paint work
+Interpreter.batchMode = True
+# One writer per CSV for the whole run, flushed after every file
+pw_counts = open_csv(csv_counts, "Image,Total_Nuclei_Count")
+pw_morph = open_csv(csv_morphology, "Image,Mean_Area,Mean_Roundness")
+try:
+    for f in files:
+        n_series = count_series(f.getAbsolutePath())
+        for idx in range(n_series):
+            imp = open_series(f, idx)
+            title = "%s_Series%d" % (f.getName(), idx + 1) if n_series > 1 else f.getName()
+            IJ.run("Close All")
+            imp.setTitle(title)
+            print("→ Processing: %s" % title)
+
+            dapi = pick_dapi_image(channel_patterns, split_channels(imp))
+            if not dapi:
+                IJ.error("No suitable channel/image found in %s" % title)
+                IJ.run("Close All"); continue
+
+            # ===== Pre-processing on grayscale 'work' (no background subtraction) =====
+            orig_w, orig_h = dapi.getWidth(), dapi.getHeight()
+            work = dapi.duplicate(); work.setTitle(title + "_work"); work.show()
+
+            if abs(SCALE_FACTOR - 1.0) > 1e-6:
+                new_w = max(1, int(round(orig_w * SCALE_FACTOR)))
+                new_h = max(1, int(round(orig_h * SCALE_FACTOR)))
+                IJ.run(work, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" %
+                       (SCALE_FACTOR, SCALE_FACTOR, new_w, new_h))
+                scaled = WindowManager.getCurrentImage()
+                try: work.changes=False; work.close()
+                except: pass
+                work = scaled
+
+            # StarDist on 'work', straight into the ROI Manager (one polygon per label, no relabeling).
+            # Run through the CommandService: the image is passed by reference instead of looked up by
+            # title, and get() returns exactly when the command has finished
+            rm = RoiManager.getInstance() or RoiManager()
+            rm.reset()
+            command.run(StarDist2D, False,
+                        "input", work, "modelChoice", model, "normalizeInput", True,
+                        "percentileBottom", 0.0, "percentileTop", 100.0,
+                        "probThresh", float(prob), "nmsThresh", float(nms),
+                        "outputType", "ROI Manager", "nTiles", n_tiles, "excludeBoundary", 2,
+                        "verbose", False, "showCsbdeepProgress", False, "showProbAndDist", False).get()
+
+            # ROIs are scaled back to the original size lazily: only those whose bounding box, scaled and then
+            # padded by a pixel on each side (rasterizing can add that for any scale), can still hold
+            # size_min pixels get their polygon rebuilt
+            rois_sd = rm.getRoisAsArray()
+            rescaled = work.getWidth() != orig_w or work.getHeight() != orig_h
+            sx = float(orig_w) / float(work.getWidth())
+            sy = float(orig_h) / float(work.getHeight())
+
+            # Size filter on the ROI pixel count; the DAPI mean comes from the same statistics call
+            dapi_ip = dapi.getProcessor()
+            rois_array, areas, means = [], [], []
+            for roi in rois_sd:
+                b = roi.getBounds()
+                if (b.width * sx + 2) * (b.height * sy + 2) < size_min: continue  # bounding box can't hold enough pixels
+                if rescaled:
+                    roi = rescale_roi_to_original(roi, sx, sy)
+                dapi_ip.setRoi(roi)
+                try: st = IS.getStatistics(dapi_ip, IS.AREA | IS.MEAN, None)
+                finally: dapi_ip.resetRoi()
+                area_px = int(st.pixelCount)
+                if area_px < size_min or area_px > size_max: continue
+                rois_array.append(roi); areas.append(area_px); means.append(float(st.mean))
+
+            # ===== NEW: compute background (outside nuclei) and filter ROIs =====
+            # The per-ROI means were gathered with the areas above; the background is only needed
+            # for the sigma filter, so the background mask is skipped entirely when that filter is off
+            min_mean = MIN_MEAN_INTENSITY if MIN_MEAN_INTENSITY > 0 else -Double.MAX_VALUE
+            if SIGMA_ABOVE_BG > 0:
+                bg_stats = background_stats(dapi.getProcessor(), rois_array, dapi.getCalibration())
+                min_mean = max(min_mean, bg_stats.mean + SIGMA_ABOVE_BG * bg_stats.stdDev)
+
+            kept_rois, areas_kept, round_kept = [], [], []
+            for i, roi in enumerate(rois_array):
+                if means[i] >= min_mean:
+                    kept_rois.append(roi)
+                    areas_kept.append(areas[i])
+                    round_kept.append(circ_from_roi(roi, areas[i]))
+
+            # Leave the kept nuclei (original-size coordinates) in the ROI Manager, refilled once per series
+            rm.reset()
+            for r in kept_rois: rm.addRoi(r)
+
+            # Recompute summary on kept ROIs
+            count = len(kept_rois)
+            round_ok = [c for c in round_kept if not Double.isNaN(c)]
+            if count > 0:
+                mean_area  = float(sum(areas_kept)) / count
+                mean_round = (sum(round_ok) / len(round_ok)) if round_ok else 0.0
+            else:
+                mean_area = 0.0; mean_round = 0.0
+
+            # CSV export
+            export_counts(pw_counts, title, count)
+            export_morphology(pw_morph, title, mean_area, mean_round)
+            print("→ %s: Count=%d" % (title, count))
+
+            # --- QC overlay on a blue RGB view of DAPI (only built when it is saved: batch mode never shows it) ---
+            if kept_rois and SAVE_QC_OVERLAYS:
+                disp = dapi.duplicate()
+                try: IJ.run(disp, "Blue", "")
+                except:
+                    try: IJ.run(disp, "Blue LUT", "")
+                    except: pass
+                IJ.run(disp, "RGB Color", "")
+                disp.setTitle(title + "_RGBview")
+                ov = Overlay()
+                legend = TextRoi(5, 5, "QC: detected nuclei\nContours in RED")
+                legend.setStrokeColor(Color.white)
+                ov.add(legend)
+                for roi in kept_rois:
+                    c = roi.clone()
+                    c.setStrokeWidth(int(QC_STROKE_WIDTH))
+                    c.setStrokeColor(QC_COLOR)
+                    ov.add(c)
+                disp.setOverlay(ov)
                 if QC_SAT_PCT > 0:
-                    IJ.run(save_copy, "Enhance Contrast", "saturated=%.3f" % float(QC_SAT_PCT))
+                    IJ.run(disp, "Enhance Contrast", "saturated=%.3f" % float(QC_SAT_PCT))
                 out_name = safe_name("%s__QC_DAPI_Blue.png" % title)
                 out_path = qc_dir.getAbsolutePath() + File.separator + out_name
-                FileSaver(save_copy).saveAsPng(out_path)
-                try: save_copy.changes=False; save_copy.close()
+                FileSaver(disp).saveAsPng(out_path)
+                try: disp.changes=False; disp.close()
                 except: pass
                 IJ.log("Saved QC overlay: " + out_path)
 
-        # Cleanup
-        try: work.changes=False; work.close()
-        except: pass
-        IJ.run("Close All")
-        grand_total += count
+            # Cleanup
+            try: work.changes=False; work.close()
+            except: pass
+            IJ.run("Close All")
+            grand_total += count
+        pw_counts.flush(); pw_morph.flush()
+
+    # Append grand total
+    export_counts(pw_counts, "TOTAL_ALL_IMAGES", grand_total)
+finally:
+    pw_counts.close(); pw_morph.close()
+    Interpreter.batchMode = False
 
-# Append grand total
-export_counts("TOTAL_ALL_IMAGES", grand_total, csv_counts)
 IJ.log("Done. QC overlays in: " + qc_dir.getAbsolutePath() if SAVE_QC_OVERLAYS else "QC overlays disabled")
 
@@ -1,17 +1,19 @@
 from ij import IJ, WindowManager, ImagePlus
 from ij.io import DirectoryChooser, FileSaver
 from ij.plugin.frame import RoiManager
-from ij.gui import Overlay, TextRoi
-from ij.measure import ResultsTable, Measurements
-from ij.plugin.filter import ParticleAnalyzer
-from ij.process import ImageStatistics as IS, ImageConverter
+from ij.gui import Overlay, TextRoi, PolygonRoi, Roi, Wand
+from ij.process import ImageStatistics as IS, ImageConverter, ImageProcessor
 from ij.plugin import RGBStackMerge
 from java.io import File, FileWriter, BufferedWriter, PrintWriter
-from java.lang import Double
+from java.lang import Double, Float
 from java.awt import Color, Font
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
-import time, re
+from loci.common import NIOFileHandle
+import re, math
+
+# Bio-Formats: 16 KB NIO buffers instead of the 1 MB default make every file open cheaper
+NIOFileHandle.setDefaultBufferSize(16384)
 
 # ==========================
 #          Settings
@@ -66,7 +68,8 @@ LABEL_FONT   = Font("SansSerif", Font.BOLD, 10)
 # ==========================
 #      Helper functions
 # ==========================
-def safe_name(s): return re.sub(r'[\\/:*?"<>|]+', '_', s)[:180]
+_SAFE_RE = re.compile(r'[\\/:*?"<>|]+')
+def safe_name(s): return _SAFE_RE.sub('_', s)[:180]
 
 def list_open_images():
     imgs = []
@@ -78,15 +81,21 @@ def list_open_images():
     except: pass
     return imgs
 
+# Series windows as (image, lowercased title) pairs so the channel picks don't re-query titles
 def list_series_images(series):
     key = (series or "").lower()
-    return [im for im in list_open_images() if key in ((im.getTitle() or "").lower())]
-
-def pick_dapi_image(patterns, candidates):
-    for im in candidates:
-        title = (im.getTitle() or "").lower()
-        if any(p in title for p in patterns):
-            return im
+    titled = [(im, (im.getTitle() or "").lower()) for im in list_open_images()]
+    return [(im, t) for im, t in titled if key in t]
+
+def pick_by_title(patterns, titled):
+    for im, t in titled:
+        if any(p in t for p in patterns): return im
+    return None
+
+def pick_dapi_image(patterns, titled):
+    im = pick_by_title(patterns, titled)
+    if im is not None: return im
+    candidates = [w for w, _ in titled]
     if len(candidates)==1: return candidates[0]
     # Fallback: use the brightest image if no window title matches the DAPI patterns
     best=None; best_mean=-1.0
@@ -109,15 +118,10 @@ def roi_centroid(roi):
         b = roi.getBounds(); m = roi.getMask()
         if m is None:
             return b.x + b.width/2.0, b.y + b.height/2.0
-        sx = sy = n = 0
-        for yy in range(b.height):
-            for xx in range(b.width):
-                if m.get(xx, yy) != 0:
-                    sx += b.x + xx + 0.5
-                    sy += b.y + yy + 0.5
-                    n += 1
-        if n>0:
-            return float(sx)/n, float(sy)/n
+        # Mask is 255 inside / 0 outside, so its center of mass is the pixel centroid
+        st = IS.getStatistics(m, IS.CENTER_OF_MASS, None)
+        if st.xCenterOfMass == st.xCenterOfMass:
+            return b.x + st.xCenterOfMass, b.y + st.yCenterOfMass
         return b.x + b.width/2.0, b.y + b.height/2.0
     except:
         b = roi.getBounds(); return b.x + b.width/2.0, b.y + b.height/2.0
@@ -141,52 +145,76 @@ def add_legend(ov, title):
         ov.add(lg)
     except: pass
 
-def export_csv(path, row, header):
+# Open a CSV for appending (64 KB buffer); header is written only when the file is new
+def open_csv(path, header):
     f = File(path); first = not f.exists()
-    pw = PrintWriter(BufferedWriter(FileWriter(f, True)))
-    try:
-        if first: pw.println(header)
-        pw.println(row)
+    pw = PrintWriter(BufferedWriter(FileWriter(f, True), 65536))
+    if first: pw.println(header)
+    return pw
+
+def export_csv(path, row, header):
+    pw = open_csv(path, header)
+    try: pw.println(row)
     finally: pw.close()
 
-def roi_pixel_iter(ip, roi):
-    if ip is None or roi is None: return
-    b = roi.getBounds(); rmask = roi.getMask()
-    W, H = ip.getWidth(), ip.getHeight()
-    for yy in range(b.height):
-        gy = b.y + yy
-        if gy<0 or gy>=H: continue
-        for xx in range(b.width):
-            gx = b.x + xx
-            if gx<0 or gx>=W: continue
-            if rmask is not None and rmask.get(xx, yy)==0: continue
-            yield gx, gy
-
-def roi_area_pixels(ip, roi):
-    c = 0
-    for _ in roi_pixel_iter(ip, roi): c += 1
-    return c
-
-def roi_mean(ip, roi):
-    s = 0; n = 0
-    for gx, gy in roi_pixel_iter(ip, roi):
-        s += ip.get(gx, gy); n += 1
-    return (float(s)/n) if n>0 else 0.0
-
-def circ_from_roi(roi):
+# ROI kernels run inside ImageJ's native statistics/histogram code instead of per-pixel Jython loops
+# Set an ROI on a processor, reusing pre-fetched bounds/mask when the ROI lies fully inside the image
+def set_roi(ip, roi, b=None, mask=None):
+    if b is not None and b.x>=0 and b.y>=0 and b.x+b.width<=ip.getWidth() and b.y+b.height<=ip.getHeight():
+        ip.setRoi(b); ip.setMask(mask)
+    else:
+        ip.setRoi(roi)
+
+def roi_stats(ip, roi, b=None, mask=None):
+    set_roi(ip, roi, b, mask)
+    try: return IS.getStatistics(ip, IS.MEAN | IS.AREA, None)
+    finally: ip.resetRoi()
+
+def roi_count_above(ip, roi, thr, b=None, mask=None):
+    # Returns (ROI pixels, ROI pixels >= thr). 8-bit reads the 256-bin ROI histogram; wider types use
+    # native limit-to-threshold statistics rather than summing a 65536-bin histogram in Jython per ROI
+    set_roi(ip, roi, b, mask)
+    try:
+        if ip.getBitDepth() == 8:
+            hist = ip.getHistogram()
+            t = max(0, int(math.ceil(thr)))
+            return sum(hist), (sum(hist[t:]) if t < len(hist) else 0)
+        n = IS.getStatistics(ip, IS.AREA, None).pixelCount
+        ip.setThreshold(thr, Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+        try: return n, IS.getStatistics(ip, IS.AREA | IS.LIMIT, None).pixelCount
+        finally: ip.resetThreshold()
+    finally: ip.resetRoi()
+
+def mask_overlap_frac(mask_ip, roi, b=None, mask=None):
+    set_roi(mask_ip, roi, b, mask)
+    try: hist = mask_ip.getHistogram()
+    finally: mask_ip.resetRoi()
+    allpix = sum(hist)
+    return (float(allpix - hist[0]) / float(allpix)) if allpix>0 else 0.0
+
+# Foreground fraction of the whole mask; 0 or 1 means every ROI gets the same AOI answer
+def mask_fill(mask_ip):
+    hist = mask_ip.getHistogram(); allpix = sum(hist)
+    return (float(allpix - hist[0]) / float(allpix)) if allpix>0 else 0.0
+
+# Circularity 4*pi*area/perimeter^2 (as reported by ParticleAnalyzer, capped at 1): the perimeter is
+# taken from the traced pixel outline of the ROI mask, like ParticleAnalyzer, not from the smooth polygon
+def traced_perimeter(roi):
+    mask = roi.getMask()
+    if mask is None:
+        b = roi.getBounds(); return 2.0 * (b.width + b.height)
+    pix = mask.getPixels(); w = mask.getWidth()
+    start = next((i for i in xrange(len(pix)) if pix[i] != 0), -1)
+    if start < 0: return 0.0
+    wand = Wand(mask); wand.autoOutline(start % w, start // w, 255.0, 255.0, Wand.LEGACY_MODE)
+    return PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI).getLength()
+
+def circ_from_roi(roi, area=None):
     try:
-        mask = roi.getMask()
-        if mask is None: return Double.NaN
-        imp_mask = ImagePlus("roiMask", mask)
-        IJ.setThreshold(imp_mask, 1, Double.POSITIVE_INFINITY)
-        rtloc = ResultsTable()
-        pa = ParticleAnalyzer(ParticleAnalyzer.SHOW_NONE,
-                              Measurements.CIRCULARITY,
-                              rtloc, 0, Double.POSITIVE_INFINITY)
-        pa.setHideOutputImage(True)
-        pa.analyze(imp_mask)
-        if rtloc.getCounter() > 0:
-            return rtloc.getValue("Circ.", 0)
+        if area is None: area = roi.getStatistics().pixelCount
+        per = traced_perimeter(roi)
+        if per > 0 and area > 0:
+            return min(1.0, 4.0*math.pi*float(area)/(per*per))
     except: pass
     return Double.NaN
 
@@ -205,23 +233,32 @@ def close_if_open(imp):
         if imp is not None: imp.changes=False; imp.close()
     except: pass
 
+# Read a virtual series into RAM once, so Split Channels and the later duplicates
+# copy memory instead of re-reading every plane through Bio-Formats
+def materialize(imp):
+    try:
+        if imp is None or not imp.getStack().isVirtual(): return imp
+    except: return imp
+    dup = safe_duplicate(imp)
+    if dup is None: return imp
+    close_if_open(imp)
+    return dup
+
+# Bilinear, averaging resize into a new ImagePlus ("Scale... create" without the dialog/window round-trip)
+def resized_copy(imp, new_w, new_h, title):
+    ip = imp.getProcessor(); ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+    return ImagePlus(title, ip.resize(new_w, new_h, True))
+
 def scale_duplicate_to(imp, scale, suffix=""):
     if imp is None: return None
     if abs(scale - 1.0) <= 1e-6:
         return safe_duplicate(imp, suffix)
-    dup = safe_duplicate(imp, suffix)
     try:
-        orig_w, orig_h = dup.getWidth(), dup.getHeight()
-        new_w = max(1, int(round(orig_w * scale)))
-        new_h = max(1, int(round(orig_h * scale)))
-        IJ.run(dup, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" % (scale, scale, new_w, new_h))
-        scaled = WindowManager.getCurrentImage()
-        if scaled is not None:
-            close_if_open(dup)
-            return scaled
+        new_w = max(1, int(round(imp.getWidth() * scale)))
+        new_h = max(1, int(round(imp.getHeight() * scale)))
+        return resized_copy(imp, new_w, new_h, (imp.getTitle() or "dup")+suffix)
     except:
-        pass
-    return dup
+        return safe_duplicate(imp, suffix)
 
 # ==========================
 #     Pipeline: process one image series
@@ -237,21 +274,21 @@ def process_series(imp, series, image_name, out_dir,
         IJ.log("Skip %s (imp=None)" % series); 
         return
 
+    # show(), Split Channels and the StarDist command are synchronous, so nothing has to be waited for
     try: imp.setTitle(series); imp.show()
     except: pass
-    time.sleep(0.2)
 
     try: IJ.run(imp, "Split Channels", "")
     except: pass
-    time.sleep(0.2)
 
-    series_wins = list_series_images(series)
+    titled = list_series_images(series)
+    series_wins = [w for w, _ in titled]
     if not series_wins:
         IJ.log("No channel windows for %s" % series); 
         close_if_open(imp); 
         return
 
-    dapi = pick_dapi_image(CHANNEL_PATTERNS, series_wins)
+    dapi = pick_dapi_image(CHANNEL_PATTERNS, titled)
     if dapi is None:
         IJ.log("No DAPI in %s" % series)
         close_if_open(imp); 
@@ -268,40 +305,25 @@ def process_series(imp, series, image_name, out_dir,
         marker_fixed.append(marker_fixed[-1] if marker_fixed else 1000.0)
 
     # Search for the AOI channel window using the configured AOI key patterns
-    aoi = None
-    if AOI_KEYS:
-        for win in series_wins:
-            t = (win.getTitle() or "").lower()
-            if any(k in t for k in AOI_KEYS):
-                aoi = win; break
+    aoi = pick_by_title(AOI_KEYS, titled) if AOI_KEYS else None
 
     # ===== StarDist (via Command From Macro) =====
-    work = safe_duplicate(dapi, "_work")
+    # Optionally downscale the working image before running StarDist to speed up detection;
+    # unscaled, StarDist reads the DAPI channel window directly (it never modifies its input)
+    work = dapi if abs(SCALE_FACTOR - 1.0) <= 1e-6 else scale_duplicate_to(dapi, SCALE_FACTOR, "_work")
     if work is None:
         IJ.log("Work duplicate failed in %s" % series)
         for w in series_wins: close_if_open(w)
         close_if_open(imp)
         return
 
-    # Optionally downscale the working image before running StarDist to speed up detection
-    if abs(SCALE_FACTOR - 1.0) > 1e-6:
-        orig_w, orig_h = work.getWidth(), work.getHeight()
-        new_w = max(1, int(round(orig_w * SCALE_FACTOR)))
-        new_h = max(1, int(round(orig_h * SCALE_FACTOR)))
+    # Give a scaled copy a stable window title and ensure the window is visible so StarDist can find it
+    # by name; unscaled, StarDist gets the DAPI channel under its own title, which must not be renamed
+    if work is not dapi:
         try:
-            IJ.run(work, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" %
-                   (SCALE_FACTOR, SCALE_FACTOR, new_w, new_h))
-            scaled = WindowManager.getCurrentImage()
-            if scaled is not None:
-                close_if_open(work); work = scaled
+            work.setTitle(series + "_work")
         except: pass
-
-    # Set a stable window title and ensure the window is visible so StarDist can find it by name
-    try:
-        work.setTitle(series + "_work")
-    except: pass
     work.show()
-    time.sleep(0.2)
 
     # Reset the ROI Manager before running StarDist to avoid leftover ROIs from previous series
     rm = RoiManager.getInstance() or RoiManager()
@@ -323,7 +345,6 @@ def process_series(imp, series, image_name, out_dir,
         for w in series_wins: close_if_open(w)
         close_if_open(imp)
         return
-    time.sleep(0.4)
 
     # Close any StarDist dialog windows and label images left open after detection
     try:
@@ -344,7 +365,6 @@ def process_series(imp, series, image_name, out_dir,
         close_if_open(work)
         for w in series_wins: close_if_open(w)
         close_if_open(imp)
-        IJ.run("Collect Garbage", "")
         return
 
     # ===== Compute background intensity outside nuclei and filter ROIs by size/intensity =====
@@ -356,15 +376,21 @@ def process_series(imp, series, image_name, out_dir,
     size_min_eff = float(size_min) * area_scale
     size_max_eff = float(size_max) * area_scale
 
+    # Single lower bound for the mean; checks run cheapest first and bail out early
+    min_mean = max(MIN_MEAN_INTENSITY if MIN_MEAN_INTENSITY>0 else -Double.MAX_VALUE,
+                   (bg_mean + SIGMA_ABOVE_BG*bg_sd) if SIGMA_ABOVE_BG>0 else -Double.MAX_VALUE)
     kept = []
     for roi in rois_array:
-        area_px = roi_area_pixels(dapi_ip, roi)
+        b = roi.getBounds()
+        if b.width*b.height < size_min_eff: continue  # bounding box can't hold enough pixels
+        rmask = roi.getMask()
+        st = roi_stats(dapi_ip, roi, b, rmask)
+        area_px = int(st.pixelCount)
         if area_px < size_min_eff or area_px > size_max_eff: continue
-        mval = roi_mean(dapi_ip, roi)
-        if (MIN_MEAN_INTENSITY>0 and mval < MIN_MEAN_INTENSITY): continue
-        if (SIGMA_ABOVE_BG>0 and mval < bg_mean + SIGMA_ABOVE_BG*bg_sd): continue
-        cval = circ_from_roi(roi)
-        kept.append((roi, {'Circ': cval}))
+        mval = float(st.mean) if area_px>0 else 0.0
+        if mval < min_mean: continue
+        cval = circ_from_roi(roi, area_px)
+        kept.append((roi, {'Circ': cval, 'Bounds': b, 'Mask': rmask}))
 
     rm.reset()
     for r,_ in kept:
@@ -375,11 +401,10 @@ def process_series(imp, series, image_name, out_dir,
         close_if_open(work)
         for w in series_wins: close_if_open(w)
         close_if_open(imp)
-        IJ.run("Collect Garbage", "")
         return
 
     # ===== Build binary AOI mask at StarDist working scale for overlap testing =====
-    aoi_mask_ip = None
+    aoi_mask_ip = None; aoi_proc = None
     if aoi is not None:
         aoi_proc = scale_duplicate_to(aoi, SCALE_FACTOR, "__AOIproc")
         if aoi_proc is not None:
@@ -394,6 +419,13 @@ def process_series(imp, series, image_name, out_dir,
                 aoi_mask_ip = aoi_proc.getProcessor()
             except: pass
 
+    # AOI membership depends only on the ROI, so test it once here rather than once per marker
+    aoi_fill = mask_fill(aoi_mask_ip) if aoi_mask_ip is not None else None
+    for roi, m in kept:
+        if aoi_fill is None: m['InAOI'] = False
+        elif aoi_fill in (0.0, 1.0): m['InAOI'] = (aoi_fill >= AOI_ROI_MIN_FRAC)
+        else: m['InAOI'] = (mask_overlap_frac(aoi_mask_ip, roi, m['Bounds'], m['Mask']) >= AOI_ROI_MIN_FRAC)
+
     # ===== Define CSV column headers for all output files =====
     COUNTS_HDR = "Image;Series;Marker;N_total;Positive;Negative;Percent_Positive;Pos_in_AOI;Neg_in_AOI;Percent_Positive_in_AOI"
     DETAIL_HDR = "Image;Series;ROI_Index;Marker;ROI_px;PosPix;Is_Positive;In_AOI"
@@ -413,144 +445,133 @@ def process_series(imp, series, image_name, out_dir,
     if not marker_list:
         IJ.log("No marker channels in %s" % series)
 
-    for midx, mwin in enumerate(marker_list[:len(marker_fixed)]):
-        thr = float(marker_fixed[midx])
-        # Duplicate and rescale the marker image to match the StarDist working resolution
-        m_imp = scale_duplicate_to(mwin, SCALE_FACTOR, "__MARKER_%d_GRAY" % (midx+1)); ensure_gray8(m_imp)
-        if m_imp is None:
-            IJ.log("Marker duplicate failed in %s" % series)
-            continue
-        m_imp.show()
-        m_ip  = m_imp.getProcessor()
-
-        ov = Overlay()
-        add_legend(ov, (mwin.getTitle() or "marker"))
-
-        pos_cnt = neg_cnt = 0
-        pos_aoi = neg_aoi = 0
-
-        n_all_m = n_pos = n_in = n_posin = 0
-        sum_all_m = sum_pos = sum_in = sum_posin = 0.0
-
-        for ridx, (roi, m) in enumerate(kept, 1):
-            total = pospix = 0
-            for gx, gy in roi_pixel_iter(m_ip, roi):
-                total += 1
-                if m_ip.get(gx, gy) >= thr: pospix += 1
-            if total == 0: 
+    # Per-ROI rows go through one writer per series instead of reopening the files per row
+    pw_detail = open_csv(csv_detail, DETAIL_HDR)
+    pw_morph  = open_csv(csv_morph_perroi, MORPH_PERROI_HDR)
+    try:
+        for midx, mwin in enumerate(marker_list[:len(marker_fixed)]):
+            thr = float(marker_fixed[midx])
+            # Duplicate and rescale the marker image to match the StarDist working resolution
+            m_imp = scale_duplicate_to(mwin, SCALE_FACTOR, "__MARKER_%d_GRAY" % (midx+1)); ensure_gray8(m_imp)
+            if m_imp is None:
+                IJ.log("Marker duplicate failed in %s" % series)
                 continue
-            is_pos = (float(pospix)/float(total) >= POS_FRAC)
-
-            in_aoi = False
-            if aoi_mask_ip is not None:
-                inside = allpix = 0
-                for gx, gy in roi_pixel_iter(aoi_mask_ip, roi):
-                    allpix += 1
-                    if aoi_mask_ip.get(gx, gy) > 0: inside += 1
-                in_aoi = (allpix>0 and float(inside)/float(allpix) >= AOI_ROI_MIN_FRAC)
-
-            if is_pos: pos_cnt += 1
-            else:      neg_cnt += 1
-            if in_aoi:
-                if is_pos: pos_aoi += 1
-                else:      neg_aoi += 1
-
-            cval = m['Circ']
-            if not Double.isNaN(cval):
-                n_all_m += 1; sum_all_m += cval
-                if is_pos: n_pos += 1; sum_pos += cval
+            m_imp.show()
+            m_ip  = m_imp.getProcessor()
+
+            ov = Overlay()
+            add_legend(ov, (mwin.getTitle() or "marker"))
+
+            pos_cnt = neg_cnt = 0
+            pos_aoi = neg_aoi = 0
+
+            n_all_m = n_pos = n_in = n_posin = 0
+            sum_all_m = sum_pos = sum_in = sum_posin = 0.0
+
+            for ridx, (roi, m) in enumerate(kept, 1):
+                total, pospix = roi_count_above(m_ip, roi, thr, m['Bounds'], m['Mask'])
+                if total == 0:
+                    continue
+                is_pos = (float(pospix)/float(total) >= POS_FRAC)
+
+                in_aoi = m['InAOI']
+
+                if is_pos: pos_cnt += 1
+                else:      neg_cnt += 1
                 if in_aoi:
-                    n_in += 1; sum_in += cval
-                    if is_pos: n_posin += 1; sum_posin += cval
-
-            # Draw nucleus outline on the overlay only if the nucleus overlaps the AOI
-            if in_aoi:
-                c = roi.clone(); c.setStrokeWidth(STROKE_W)
-                if is_pos:
-                    c.setStrokeColor(COLOR_POS); add_label(ov, roi, "P", COLOR_POS)
-                else:
-                    c.setStrokeColor(COLOR_NEG); add_label(ov, roi, "N", COLOR_NEG)
-                ov.add(c)
-
-            # Write per-nucleus rows to the detail and morphology CSVs
-            export_csv(csv_detail, "%s;%s;%d;%s;%d;%d;%s;%s" % (
-                image_name, series, ridx, (mwin.getTitle() or "marker"), total, pospix,
-                ("TRUE" if is_pos else "FALSE"), ("TRUE" if in_aoi else "FALSE")
-            ), DETAIL_HDR)
-            circ_str = ("%.6f" % cval) if not Double.isNaN(cval) else ""
-            export_csv(csv_morph_perroi, "%s;%s;%d;%s;%s;%s;%s" % (
-                image_name, series, ridx, (mwin.getTitle() or "marker"), circ_str,
-                ("TRUE" if is_pos else "FALSE"),
-                ("TRUE" if in_aoi else "FALSE")
-            ), MORPH_PERROI_HDR)
-
-        pct_total = (100.0*pos_cnt/float(pos_cnt+neg_cnt)) if (pos_cnt+neg_cnt)>0 else 0.0
-        pct_aoi   = (100.0*pos_aoi/float(pos_aoi+neg_aoi)) if (pos_aoi+neg_aoi)>0 else 0.0
-        export_csv(csv_counts, "%s;%s;%s;%d;%d;%d;%.6f;%d;%d;%.6f" % (
-            image_name, series, (mwin.getTitle() or "marker"), (pos_cnt+neg_cnt),
-            pos_cnt, neg_cnt, pct_total, pos_aoi, neg_aoi, pct_aoi
-        ), COUNTS_HDR)
-
-        # Write per-marker morphology summary row with circularity statistics
-        mean_all = (sum_all_m/n_all_m) if n_all_m>0 else 0.0
-        mean_pos = (sum_pos/n_pos) if n_pos>0 else 0.0
-        mean_in  = (sum_in/n_in) if n_in>0 else 0.0
-        mean_posin = (sum_posin/n_posin) if n_posin>0 else 0.0
-        export_csv(csv_morph_summary_marker, "%s;%s;%s;%d;%.6f;%d;%.6f;%d;%.6f;%d;%.6f" % (
-            image_name, series, (mwin.getTitle() or "marker"), n_all_m, mean_all, n_pos, mean_pos, n_in, mean_in, n_posin, mean_posin
-        ), MORPH_SUM_MARKER_HDR)
-
-        # ==== PNGs ====
-        flat = combo = flat_back = None
-        dapi_gray = scale_duplicate_to(dapi, SCALE_FACTOR, "__DAPI_scaled")
-        mrk_gray  = scale_duplicate_to(mwin, SCALE_FACTOR, "__MRK_scaled")
-        ok = (dapi_gray is not None and mrk_gray is not None and
-              dapi_gray.getWidth()==mrk_gray.getWidth() and dapi_gray.getHeight()==mrk_gray.getHeight())
-        if ok:
-            ensure_gray8(dapi_gray); ensure_gray8(mrk_gray)
-            mrk_R = safe_duplicate(mrk_gray)
-            mrk_G = safe_duplicate(mrk_gray)
-            try: IJ.run(mrk_G, "Multiply...", "value=0.60")
-            except: pass
-            try:
-                combo = RGBStackMerge.mergeChannels([mrk_R, mrk_G, dapi_gray], False)  # [R,G,B]
-                combo.setTitle(series+"__SCALED_PosNeg")
-                combo.setOverlay(ov)
-                flat = combo.flatten()
-                if abs(SCALE_FACTOR - 1.0) > 1e-6:
-                    orig_w, orig_h = dapi.getWidth(), dapi.getHeight()
-                    IJ.run(flat, "Scale...", "x=%f y=%f width=%d height=%d interpolation=Bilinear average create" % (1.0/SCALE_FACTOR, 1.0/SCALE_FACTOR, orig_w, orig_h))
-                    flat_back = WindowManager.getCurrentImage()
-                else:
-                    flat_back = flat
-                FileSaver(flat_back).saveAsPng(
-                    out_dir.getAbsolutePath() + File.separator +
-                    safe_name("%s__%s__ORIG_PosNeg.png" % (series, (mwin.getTitle() or "marker")))
-                )
-            finally:
-                for imx in [flat, combo, dapi_gray, mrk_gray, mrk_R, mrk_G]:
-                    if imx is not flat_back: close_if_open(imx)
-                close_if_open(flat_back)
-        else:
-            IJ.log("Skip PNG (size mismatch) in %s" % series)
-
-        if not SHOW_AT_END:
-            close_if_open(m_imp)
-            IJ.run("Collect Garbage", "")
+                    if is_pos: pos_aoi += 1
+                    else:      neg_aoi += 1
+
+                cval = m['Circ']
+                if not Double.isNaN(cval):
+                    n_all_m += 1; sum_all_m += cval
+                    if is_pos: n_pos += 1; sum_pos += cval
+                    if in_aoi:
+                        n_in += 1; sum_in += cval
+                        if is_pos: n_posin += 1; sum_posin += cval
+
+                # Draw nucleus outline on the overlay only if the nucleus overlaps the AOI
+                if in_aoi:
+                    c = roi.clone(); c.setStrokeWidth(STROKE_W)
+                    if is_pos:
+                        c.setStrokeColor(COLOR_POS); add_label(ov, roi, "P", COLOR_POS)
+                    else:
+                        c.setStrokeColor(COLOR_NEG); add_label(ov, roi, "N", COLOR_NEG)
+                    ov.add(c)
+
+                # Write per-nucleus rows to the detail and morphology CSVs
+                pw_detail.println("%s;%s;%d;%s;%d;%d;%s;%s" % (
+                    image_name, series, ridx, (mwin.getTitle() or "marker"), total, pospix,
+                    ("TRUE" if is_pos else "FALSE"), ("TRUE" if in_aoi else "FALSE")
+                ))
+                circ_str = ("%.6f" % cval) if not Double.isNaN(cval) else ""
+                pw_morph.println("%s;%s;%d;%s;%s;%s;%s" % (
+                    image_name, series, ridx, (mwin.getTitle() or "marker"), circ_str,
+                    ("TRUE" if is_pos else "FALSE"),
+                    ("TRUE" if in_aoi else "FALSE")
+                ))
+
+            pct_total = (100.0*pos_cnt/float(pos_cnt+neg_cnt)) if (pos_cnt+neg_cnt)>0 else 0.0
+            pct_aoi   = (100.0*pos_aoi/float(pos_aoi+neg_aoi)) if (pos_aoi+neg_aoi)>0 else 0.0
+            export_csv(csv_counts, "%s;%s;%s;%d;%d;%d;%.6f;%d;%d;%.6f" % (
+                image_name, series, (mwin.getTitle() or "marker"), (pos_cnt+neg_cnt),
+                pos_cnt, neg_cnt, pct_total, pos_aoi, neg_aoi, pct_aoi
+            ), COUNTS_HDR)
+
+            # Write per-marker morphology summary row with circularity statistics
+            mean_all = (sum_all_m/n_all_m) if n_all_m>0 else 0.0
+            mean_pos = (sum_pos/n_pos) if n_pos>0 else 0.0
+            mean_in  = (sum_in/n_in) if n_in>0 else 0.0
+            mean_posin = (sum_posin/n_posin) if n_posin>0 else 0.0
+            export_csv(csv_morph_summary_marker, "%s;%s;%s;%d;%.6f;%d;%.6f;%d;%.6f;%d;%.6f" % (
+                image_name, series, (mwin.getTitle() or "marker"), n_all_m, mean_all, n_pos, mean_pos, n_in, mean_in, n_posin, mean_posin
+            ), MORPH_SUM_MARKER_HDR)
+
+            # ==== PNGs ====
+            flat = combo = flat_back = None
+            dapi_gray = scale_duplicate_to(dapi, SCALE_FACTOR, "__DAPI_scaled")
+            mrk_gray  = scale_duplicate_to(mwin, SCALE_FACTOR, "__MRK_scaled")
+            ok = (dapi_gray is not None and mrk_gray is not None and
+                  dapi_gray.getWidth()==mrk_gray.getWidth() and dapi_gray.getHeight()==mrk_gray.getHeight())
+            if ok:
+                ensure_gray8(dapi_gray); ensure_gray8(mrk_gray)
+                mrk_R = safe_duplicate(mrk_gray)
+                mrk_G = safe_duplicate(mrk_gray)
+                try: IJ.run(mrk_G, "Multiply...", "value=0.60")
+                except: pass
+                try:
+                    combo = RGBStackMerge.mergeChannels([mrk_R, mrk_G, dapi_gray], False)  # [R,G,B]
+                    combo.setTitle(series+"__SCALED_PosNeg")
+                    combo.setOverlay(ov)
+                    flat = combo.flatten()
+                    if abs(SCALE_FACTOR - 1.0) > 1e-6:
+                        flat_back = resized_copy(flat, dapi.getWidth(), dapi.getHeight(), series+"__ORIG_PosNeg")
+                    else:
+                        flat_back = flat
+                    FileSaver(flat_back).saveAsPng(
+                        out_dir.getAbsolutePath() + File.separator +
+                        safe_name("%s__%s__ORIG_PosNeg.png" % (series, (mwin.getTitle() or "marker")))
+                    )
+                finally:
+                    for imx in [flat, combo, dapi_gray, mrk_gray, mrk_R, mrk_G]:
+                        if imx is not flat_back: close_if_open(imx)
+                    close_if_open(flat_back)
+            else:
+                IJ.log("Skip PNG (size mismatch) in %s" % series)
+
+            if not SHOW_AT_END:
+                close_if_open(m_imp)
+    finally:
+        pw_detail.close(); pw_morph.close()
 
     # Close the AOI processing window that was opened during mask generation
-    try:
-        for imx in list_open_images():
-            if imx and ("__AOIproc" in (imx.getTitle() or "")):
-                close_if_open(imx)
-    except: pass
+    close_if_open(aoi_proc)
 
-    # Release all resources for this series and run garbage collection
-    close_if_open(work)
+    # Release all resources for this series (garbage collection runs once per file)
+    if work is not dapi: close_if_open(work)
     if not SHOW_AT_END:
         for w in series_wins: close_if_open(w)
         close_if_open(imp)
-    IJ.run("Collect Garbage", "")
 
 # ==========================
 #      Main process: iterate over all input files
@@ -599,7 +620,7 @@ for f in files:
     seen = set()
     for i, imp in enumerate(imps):
         nm = (imp.getTitle() or "Series%d" % (i+1))
-        nm = re.sub(r'[\\/:*?"<>|]+', '_', nm).strip()
+        nm = _SAFE_RE.sub('_', nm).strip()
         base = nm; k=1
         while nm.lower() in seen:
             k+=1; nm = "%s_%d" % (base, k)
@@ -652,6 +673,7 @@ for f in files:
                 continue
 
         # No splitting: process the full series directly
+        imp = materialize(imp)
         process_series(imp, series, image_name, out_dir,
                        AOI_KEYS, AOI_THR, APPLY_BG_AOI, AOI_ROLLING_RADIUS, AOI_ROLLING_REPEAT, AOI_MEDIAN_RADIUS,
                        size_min, size_max, MIN_MEAN_INTENSITY, SIGMA_ABOVE_BG,
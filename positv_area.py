@@ -1,13 +1,20 @@
 # Fiji / Jython: Measure percentage area with optional auto-threshold, stack splitting (series/time/z, first/second half), CSV output, and colored mask/overlay export
 from ij import IJ, WindowManager, ImagePlus
 from ij.io import DirectoryChooser, FileSaver
-from ij.process import ByteProcessor, ImageProcessor
+from ij.macro import Interpreter
+from ij.plugin import ChannelSplitter
+from ij.process import ByteProcessor, ImageProcessor, Blitter
 from ij.gui import Overlay
 from java.awt import Color
+from java.lang import Float
 from java.io import File, FileWriter, BufferedWriter, PrintWriter
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
-import time, re
+from loci.common import NIOFileHandle
+import re
+
+# Small (16 KB) NIO buffers: Bio-Formats no longer allocates 1 MB per opened file
+NIOFileHandle.setDefaultBufferSize(16384)
 
 # ====================== One-time user prompts at script start =====================
 # Channel identifiers: comma-separated substrings matched against window titles
@@ -51,17 +58,22 @@ SAVE_BINARY_MAP = True
 SAVE_HEATMAP    = IJ.getString("Also save heatmap copy? (yes/no)", "no").lower().strip() in ("ja","j","yes","y","true","t","1")
 
 # ====================== Helper functions ======================
-def export_area_row(csv_path, image_name, total_name, pos_name, total_area_px, pos_area_px, percent_pos):
+# Opens a CSV for appending through a 64 KB buffer; the header is written only when the file is new
+def open_csv(csv_path):
     f = File(csv_path); first = not f.exists()
-    pw = PrintWriter(BufferedWriter(FileWriter(f, True)))
+    pw = PrintWriter(BufferedWriter(FileWriter(f, True), 65536))
     if first: pw.println("Image;Total_Channel;Positive_Channel;Total_Area_px;Positive_Area_px;Percent_Positive")
+    return pw
+
+def export_area_row(pw, image_name, total_name, pos_name, total_area_px, pos_area_px, percent_pos):
     percent_str = ("%.6f" % float(percent_pos)).replace(".", ",")
     pw.println("%s;%s;%s;%d;%d;%s" % (image_name, total_name, pos_name, int(total_area_px), int(pos_area_px), percent_str))
-    pw.close()
 
 def preprocess_and_threshold(imp, fixed_val, use_auto=False, method="", factor=1.0):
-    ch = imp.duplicate(); ch.hide()
+    # Only background correction changes pixels: without it the split channel itself is thresholded
+    ch = imp
     if apply_bg:
+        ch = imp.duplicate(); ch.hide()
         if MEDIAN_RADIUS > 0: IJ.run(ch, "Median...", "radius=%d" % int(MEDIAN_RADIUS))
         for _ in range(max(1, int(ROLLING_REPEAT))):
             IJ.run(ch, "Subtract Background...", "rolling=%d" % int(ROLLING_RADIUS))
@@ -82,14 +94,17 @@ def preprocess_and_threshold(imp, fixed_val, use_auto=False, method="", factor=1
     except: pass
     return ch, thr_eff, ip
 
+# Binary mask (255 where pixel >= thr) built by ImageJ, and its pixel count from the mask histogram
 def make_mask(ip, thr_eff):
-    w, h = ip.getWidth(), ip.getHeight()
-    idxset = set(); k = 0; v = int(thr_eff)
-    for y in range(h):
-        for x in range(w):
-            if ip.get(x, y) >= v: idxset.add(k)
-            k += 1
-    return idxset, w, h
+    ip.setThreshold(int(thr_eff), Float.MAX_VALUE, ImageProcessor.NO_LUT_UPDATE)
+    try: bp = ip.createMask()
+    finally: ip.resetThreshold()
+    return bp, bp.getHistogram()[255]
+
+# Channels of a series straight from ChannelSplitter; single-channel images stay as they are
+def split_channels(imp):
+    if imp.getType() != ImagePlus.COLOR_RGB and imp.getNChannels() <= 1: return [imp]
+    return list(ChannelSplitter.split(imp))
 
 def find_channels_by_keys(windows, keys):
     hits = []
@@ -107,11 +122,6 @@ def ensure_dir(path):
     if not d.exists(): d.mkdir()
     return d
 
-def idxset_to_bp(idxset, w, h):
-    bp = ByteProcessor(w, h)
-    for k in idxset: bp.set(k % w, k // w, 255)
-    return bp
-
 def mask_to_roi(bp):
     if bp is None: return None
     imp_mask = ImagePlus("mask", bp.duplicate())
@@ -150,13 +160,11 @@ def save_masks_and_overlay(total_bp, pos_bp, out_dir, base_name):
         pr.setStrokeColor(Color(255,165,0)); pr.setStrokeWidth(1.5); pr.setFillColor(Color(255,165,0,230)); ov.add(pr)
     bg.setOverlay(ov); flat = bg.flatten(); FileSaver(flat).saveAsTiff(out_ovl); flat.close(); bg.close()
 
-def save_pos_map(total_mask, pos_ip, p_thr, w, h, out_dir, base_name):
-    bp = ByteProcessor(w, h); k = 0; pos_px = 0; v = int(p_thr)
-    for y in range(h):
-        for x in range(w):
-            if k in total_mask and pos_ip.get(x, y) >= v:
-                bp.set(x, y, 255); pos_px += 1
-            k += 1
+# Positive pixels inside the total mask: the positive-channel mask ANDed with the total mask
+def save_pos_map(total_bp, pos_ip, p_thr, out_dir, base_name):
+    bp, _ = make_mask(pos_ip, p_thr)
+    bp.copyBits(total_bp, 0, 0, Blitter.AND)
+    pos_px = bp.getHistogram()[255]
     imp_map = ImagePlus(base_name + "_POSmap", bp)
     if SAVE_BINARY_MAP:
         FileSaver(imp_map).saveAsTiff(File(out_dir, base_name + "_POSmap_binary.tif").getAbsolutePath())
@@ -199,82 +207,86 @@ well_csv_file = folder + File.separator + "percent_area_measurements_per_well.cs
 maps_dir      = ensure_dir(folder + File.separator + "maps")
 
 # ============================ Main processing ============================
-for f in files:
-    well_total_area = 0; well_pos_area = 0
-    well_total_name = ""; well_pos_name = ""
-
-    opts = ImporterOptions(); opts.setId(f.getAbsolutePath()); opts.setOpenAllSeries(True); opts.setVirtual(True)
-    imps = BF.openImagePlus(opts)
-    if not imps: continue
-
-    # --- Series split: select only the first or second half of all series ---
-    series_indices = range(len(imps))
-    if SPLIT_BY == "series" and len(imps) > 1:
-        total = len(imps); cut = total // 2
-        series_indices = range(0, cut) if SPLIT_WHICH == "first" else range(cut, total)
-
-    for sidx in series_indices:
-        imp = imps[sidx]
-        series_name = "%s_Series%d" % (f.getName(), sidx + 1) if len(imps) > 1 else f.getName()
-        imp.setTitle(series_name); imp.show()
-
-        # --- Time/Z split: duplicate the selected sub-stack and analyse it ---
-        part = duplicate_half(imp, SPLIT_BY, SPLIT_WHICH)
-        if part != imp:
-            try: imp.changes = False; imp.close()
+# Batch mode: series, split channels and working copies are tracked by title without opening windows
+Interpreter.batchMode = True
+pw_area = open_csv(csv_file); pw_well = open_csv(well_csv_file)
+try:
+    for f in files:
+        well_total_area = 0; well_pos_area = 0
+        well_total_name = ""; well_pos_name = ""
+
+        opts = ImporterOptions(); opts.setId(f.getAbsolutePath()); opts.setOpenAllSeries(True); opts.setVirtual(True)
+        imps = BF.openImagePlus(opts)
+        if not imps: continue
+
+        # --- Series split: select only the first or second half of all series ---
+        series_indices = range(len(imps))
+        if SPLIT_BY == "series" and len(imps) > 1:
+            total = len(imps); cut = total // 2
+            series_indices = range(0, cut) if SPLIT_WHICH == "first" else range(cut, total)
+
+        for sidx in series_indices:
+            imp = imps[sidx]
+            series_name = "%s_Series%d" % (f.getName(), sidx + 1) if len(imps) > 1 else f.getName()
+            imp.setTitle(series_name); imp.show()
+
+            # --- Time/Z split: duplicate the selected sub-stack and analyse it ---
+            part = duplicate_half(imp, SPLIT_BY, SPLIT_WHICH)
+            if part != imp:
+                try: imp.changes = False; imp.close()
+                except: pass
+                imp = part
+                series_name = imp.getTitle()
+
+            # --- Split channels and identify total/positive channel windows ---
+            windows = split_channels(imp)
+            total_chs = find_channels_by_keys(windows, TOTAL_CHANNEL_KEYS)
+            pos_chs   = find_channels_by_keys(windows,   POS_CHANNEL_KEYS)
+            if not total_chs or not pos_chs:
+                IJ.log("Warning: total or positive channel missing in %s" % series_name)
+                IJ.run("Close All"); continue
+            t_win, p_win = total_chs[0], pos_chs[0]
+
+            if well_total_name == "" and well_pos_name == "":
+                well_total_name = t_win.getTitle(); well_pos_name = p_win.getTitle()
+
+            # --- Threshold and measure the total (AOI) channel ---
+            total_img, t_thr, t_ip = preprocess_and_threshold(t_win, T_FIXED, use_auto=AUTO_THRESHOLD, method=T_METHOD, factor=T_FACTOR)
+            total_bp, total_area_px = make_mask(t_ip, t_thr)
+
+            # --- Threshold the positive marker channel and count pixels inside the total mask ---
+            pos_img, p_thr, p_ip   = preprocess_and_threshold(p_win, P_FIXED, use_auto=AUTO_THRESHOLD, method=P_METHOD, factor=P_FACTOR)
+            base = "%s__Total[%s]__Pos[%s]" % (series_name, t_win.getTitle(), p_win.getTitle())
+            pos_in_total, pos_bp   = (0, None) if total_area_px == 0 else save_pos_map(total_bp, p_ip, p_thr, maps_dir, base)
+
+            # --- Save colored mask images and a combined comparison overlay ---
+            try: save_masks_and_overlay(total_bp, pos_bp, maps_dir, base)
+            except Exception as e: IJ.log("Mask/overlay save failed in %s: %s" % (series_name, str(e)))
+
+            # --- Write per-series row to the measurements CSV ---
+            percent_pos = 0.0 if total_area_px == 0 else (100.0 * float(pos_in_total) / float(total_area_px))
+            export_area_row(pw_area, series_name, t_win.getTitle(), p_win.getTitle(), total_area_px, pos_in_total, percent_pos)
+
+            # --- Accumulate per-well totals across all series of this file ---
+            well_total_area += total_area_px
+            well_pos_area   += (0 if pos_in_total is None else pos_in_total)
+
+            # --- Close temporary images for this series ---
+            try: total_img.changes = False; total_img.close()
             except: pass
-            imp = part
-            series_name = imp.getTitle()
-
-        # --- Split channels and identify total/positive channel windows ---
-        IJ.run(imp, "Split Channels", ""); time.sleep(0.3)
-        windows = [WindowManager.getImage(i) for i in range(1, WindowManager.getImageCount() + 1) if WindowManager.getImage(i) is not None]
-        total_chs = find_channels_by_keys(windows, TOTAL_CHANNEL_KEYS)
-        pos_chs   = find_channels_by_keys(windows,   POS_CHANNEL_KEYS)
-        if not total_chs or not pos_chs:
-            IJ.log("Warning: total or positive channel missing in %s" % series_name)
-            WindowManager.closeAllWindows(); continue
-        t_win, p_win = total_chs[0], pos_chs[0]
-
-        if well_total_name == "" and well_pos_name == "":
-            well_total_name = t_win.getTitle(); well_pos_name = p_win.getTitle()
-
-        # --- Threshold and measure the total (AOI) channel ---
-        total_img, t_thr, t_ip = preprocess_and_threshold(t_win, T_FIXED, use_auto=AUTO_THRESHOLD, method=T_METHOD, factor=T_FACTOR)
-        total_mask, w, h       = make_mask(t_ip, t_thr)
-        total_area_px          = len(total_mask)
-        total_bp               = idxset_to_bp(total_mask, w, h)
-
-        # --- Threshold the positive marker channel and count pixels inside the total mask ---
-        pos_img, p_thr, p_ip   = preprocess_and_threshold(p_win, P_FIXED, use_auto=AUTO_THRESHOLD, method=P_METHOD, factor=P_FACTOR)
-        base = "%s__Total[%s]__Pos[%s]" % (series_name, t_win.getTitle(), p_win.getTitle())
-        pos_in_total, pos_bp   = (0, None) if total_area_px == 0 else save_pos_map(total_mask, p_ip, p_thr, w, h, maps_dir, base)
-
-        # --- Save colored mask images and a combined comparison overlay ---
-        try: save_masks_and_overlay(total_bp, pos_bp, maps_dir, base)
-        except Exception as e: IJ.log("Mask/overlay save failed in %s: %s" % (series_name, str(e)))
-
-        # --- Write per-series row to the measurements CSV ---
-        percent_pos = 0.0 if total_area_px == 0 else (100.0 * float(pos_in_total) / float(total_area_px))
-        export_area_row(csv_file, series_name, t_win.getTitle(), p_win.getTitle(), total_area_px, pos_in_total, percent_pos)
-
-        # --- Accumulate per-well totals across all series of this file ---
-        well_total_area += total_area_px
-        well_pos_area   += (0 if pos_in_total is None else pos_in_total)
-
-        # --- Close temporary images for this series ---
-        try: total_img.changes = False; total_img.close()
-        except: pass
-        try: pos_img.changes = False; pos_img.close()
-        except: pass
-        for win in windows:
-            try: win.changes = False; win.close()
+            try: pos_img.changes = False; pos_img.close()
             except: pass
-        try: imp.changes = False; imp.close()
-        except: pass
-        WindowManager.closeAllWindows()
-
-    # --- Write per-well summary row aggregating all series of this file ---
-    well_percent = 0.0 if well_total_area == 0 else (100.0 * float(well_pos_area) / float(well_total_area))
-    export_area_row(well_csv_file, f.getName(), well_total_name, well_pos_name, well_total_area, well_pos_area, well_percent)
-
+            for win in windows:
+                try: win.changes = False; win.close()
+                except: pass
+            try: imp.changes = False; imp.close()
+            except: pass
+            IJ.run("Close All")  # batch-mode images have no windows for closeAllWindows to find
+
+        # --- Write per-well summary row aggregating all series of this file ---
+        well_percent = 0.0 if well_total_area == 0 else (100.0 * float(well_pos_area) / float(well_total_area))
+        export_area_row(pw_well, f.getName(), well_total_name, well_pos_name, well_total_area, well_pos_area, well_percent)
+        pw_area.flush(); pw_well.flush()
+finally:
+    pw_area.close(); pw_well.close()
+    Interpreter.batchMode = False